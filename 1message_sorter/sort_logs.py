@@ -1,164 +1,285 @@
 import re
+import sys
+import mmap
+import heapq
+from bisect import bisect_left
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from operator import itemgetter
 import os
-from datetime import datetime
+from typing import Optional
+
+# Начало новой записи лога (Railway-формат с 'T' или обычный с пробелом).
+# Ищется по байтам отображённого в память файла, поэтому шаблон байтовый.
+_CHUNK_START = re.compile(rb'^\d{4}-\d{2}-\d{2}[T ]', re.MULTILINE)
+
+# Регулярные выражения для поиска вопросов и ответов в логах.
+# ВАЖНО: Логи с Railway могут не содержать закрывающей кавычки, поэтому текст берём
+# до первой кавычки или до конца записи. Класс [^'] сам по себе захватывает переводы строк,
+# так что многострочные сообщения работают без DOTALL.
+# Шаблоны байтовые: сопоставляем сырые байты файла, а в str декодируем только нужные группы.
+# Вопрос: 2025-11-08 15:20:12 - [РУ]Voron (12345) написал: 'Привет, Пончик!' 
+# или: 2025-11-08 15:20:12 - [РУ]Voron (12345) написал: 'Привет, Пончик
+QUESTION_PATTERN = re.compile(
+    r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - \[РУ\]([^(]+) \(\d+\) написал: '([^']*)".encode('utf-8')
+)
+# Ответ: 2025-11-08 15:20:15 - [РУ]Бот ответил Voron (12345) (модель: llama): 'Здарова...' или без кавычки в конце
+# Служебная часть ответа (модель, token usage) всегда на первой строке записи.
+# Текст ответа без закрывающей кавычки заканчивается перед последним переводом строки записи
+# (как `$` при чтении в текстовом режиме; файл читается байтами, поэтому учитываем и CRLF/CR).
+ANSWER_PATTERN = re.compile(
+    r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - \[РУ\]Бот ответил ([^(]+) \(\d+\).*?\(модель: ([^)]+)\)(?:\s*(\(token usage:\s*\d+\)))?.*?: '((?:[^']|\\')*?)(?:'|(?:\r\n|\r|\n)?\Z)".encode('utf-8')
+)
+
+# Связанные методы поиска: экономим поиск атрибута на каждой записи
+Q_SEARCH = QUESTION_PATTERN.search
+A_SEARCH = ANSWER_PATTERN.search
+
+# Дешёвые подстроки-маркеры: регулярки запускаем, только если маркер есть в записи.
+# Большая часть лога (служебные записи) не содержит ни одного из них.
+QUESTION_MARKER = "написал: '".encode('utf-8')
+ANSWER_MARKER = "Бот ответил".encode('utf-8')
+
+# Признаки ответа-ошибки: "Хм, чёт у меня какие-то неполадки... Напиши потом.",
+# "...(токены закончились, напиши через несколько часов)" и похожие.
+# Один проход регулярки без учёта регистра вместо нескольких any() и копии answer_text.lower().
+ERROR_RE = re.compile(r"токен|неполад|напиши потом", re.IGNORECASE)
+ERROR_SEARCH = ERROR_RE.search
+
+
+class _PendingQuestions:
+    """
+    Неотвеченные вопросы одного пользователя в порядке времени.
+    Метки времени хранятся отдельным списком, чтобы искать по ним через bisect
+    (ISO-строки сравниваются корректно и без разбора в datetime).
+    Ответ обычно приходит на последний заданный вопрос — он снимается с конца списка через pop().
+    Вопросы, извлечённые из начала, не удаляются сразу, а отсекаются смещением head:
+    список компактируется, только когда мёртвая голова становится больше живой части.
+    """
+    __slots__ = ('ts_list', 'entries', 'head')
+
+    def __init__(self):
+        self.ts_list = []
+        self.entries = []
+        self.head = 0
+
+    def append(self, timestamp: str, text: str) -> None:
+        self.ts_list.append(timestamp)
+        self.entries.append((timestamp, text))
+
+    def remaining(self) -> list:
+        """Оставшиеся (неотвеченные) вопросы в порядке времени."""
+        return self.entries[self.head:]
+
+    def pop_latest_before(self, timestamp: str):
+        """Извлекает самый поздний вопрос, заданный строго раньше timestamp, или возвращает None."""
+        idx = bisect_left(self.ts_list, timestamp, self.head) - 1
+        if idx < self.head:
+            return None
+        if idx == len(self.ts_list) - 1:
+            # Частый случай: ответ на последний вопрос
+            self.ts_list.pop()
+            return self.entries.pop()
+        entry = self.entries[idx]
+        if idx == self.head:
+            # Ответ на самый старый из оставшихся вопросов: сдвигаем голову без копирования
+            self.head += 1
+            if self.head * 2 > len(self.ts_list):
+                del self.ts_list[:self.head]
+                del self.entries[:self.head]
+                self.head = 0
+        else:
+            # Редкий случай: ответ на вопрос из середины
+            del self.ts_list[idx]
+            del self.entries[idx]
+        return entry
+
+
+def _normalize_newlines(raw: bytes) -> bytes:
+    """Приводит переводы строк CRLF/CR к LF, как при чтении в текстовом режиме."""
+    if b'\r' in raw:
+        raw = raw.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return raw
+
+
+def _map_file(f):
+    """
+    Отображает открытый файл в память только для чтения.
+    Пустой файл отобразить нельзя, поэтому для него возвращаем пустые байты.
+    """
+    if os.fstat(f.fileno()).st_size:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return nullcontext(b"")
+
+
+def _decode(raw: bytes) -> str:
+    """Декодирует захваченную группу из байтов лога."""
+    return _normalize_newlines(raw).decode('utf-8')
+
+
+# Статусы диалога. Сами диалоги храним компактными кортежами
+# (время вопроса, вопрос, ответ, модель, token usage, статус)
+# и превращаем в текст только в момент записи в файл.
+DIALOG_ANSWERED = 0
+DIALOG_ERROR = 1
+DIALOG_NO_ANSWER = 2
+
+# Разделители блоков итогового файла
+SEP = "*" * 50
+SERVICE_SEP = "=" * 60
+
+
+def _format_dialog(username: str, entry: tuple) -> str:
+    """Форматирует один диалог для итогового файла."""
+    question_timestamp, question_text, answer_text, model_used, token_usage, status = entry
+    if status == DIALOG_ERROR:
+        answer_line = f"🤖 Ответ: [ОШИБКА] {answer_text}"
+    elif status == DIALOG_NO_ANSWER:
+        answer_line = "🤖 Ответ: [НЕТ ОТВЕТА]"
+    else:
+        # Включаем (token usage: N) если он присутствует в исходном логе
+        tu_part = f" {token_usage}" if token_usage else ""
+        answer_line = f"🤖 Ответ (модель: {model_used}{tu_part}): {answer_text}"
+    return (
+        f"({question_timestamp})\n"
+        f"👤 Пользователь: {username}\n"
+        f"❓ Вопрос: {question_text}\n"
+        f"{answer_line}\n\n"
+    )
+
 
 def sort_log_file(input_filename: str, output_filename: str):
     """
     Фильтрует и сортирует лог-файл, создавая читаемый диалог "вопрос-ответ".
     Служебные логи (Token Usage и т.д.) собираются в отдельный раздел.
     """
-    # Регулярные выражения для поиска вопросов и ответов в логах.
-    # Используем DOTALL для обработки многострочных логов
-    # ВАЖНО: Логи с Railway могут не содержать закрывающей кавычки, поэтому её опциональна
-    # Вопрос: 2025-11-08 15:20:12 - [РУ]Voron (12345) написал: 'Привет, Пончик!' 
-    # или: 2025-11-08 15:20:12 - [РУ]Voron (12345) написал: 'Привет, Пончик
-    question_pattern = re.compile(
-        r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - \[РУ\]([^(]+) \(\d+\) написал: '((?:[^']|\\')*)(?:'|$)",
-        re.DOTALL
-    )
-    # Ответ: 2025-11-08 15:20:15 - [РУ]Бот ответил Voron (12345) (модель: llama): 'Здарова...' или без кавычки в конце
-    answer_pattern = re.compile(
-        r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - \[РУ\]Бот ответил ([^(]+) \(\d+\).*?\(модель: ([^)]+)\)(?:\s*(\(token usage:\s*\d+\)))?.*?: '((?:[^']|\\')*?)(?:'|$)",
-        re.DOTALL
-    )
-
     # Словарь для хранения вопросов, на которые еще не было ответа.
-    # Используем defaultdict(list), чтобы хранить несколько вопросов от одного юзера.
-    pending_questions = defaultdict(list)
+    # Используем defaultdict(_PendingQuestions), чтобы хранить несколько вопросов от одного юзера.
+    pending_questions = defaultdict(_PendingQuestions)
     # Словарь для хранения всех диалогов, сгруппированных по пользователю (все типы вместе).
+    # Диалоги добавляются в порядке чтения файла, т.е. почти всегда уже отсортированы по времени.
     all_dialogs = defaultdict(list)
-    # Список для сбора служебных логов (Token Usage и т.д.), которые не должны быть в диалогах
-    service_logs = []
+    # Пользователи, у которых порядок диалогов нарушился (ответ пришёл не на самый старый вопрос)
+    unordered_users = set()
+    # Вопросы без ответа, собираются отдельно и вливаются в диалоги при записи
+    unanswered_dialogs = defaultdict(list)
+    # Служебные логи (Token Usage и т.д.), которые не должны быть в диалогах.
+    # Храним только границы (начало, конец) в отображённом файле, а не копии текста.
+    service_ranges = []
+
+    def _process_chunk(buf, chunk_start: int, chunk_end: int) -> None:
+        """Разбирает одну (возможно, многострочную) запись лога buf[chunk_start:chunk_end]."""
+        log_chunk = buf[chunk_start:chunk_end]
+        if not log_chunk.strip():
+            return
+
+        # Каждый log_chunk может быть многострочным
+        question_match = Q_SEARCH(log_chunk) if QUESTION_MARKER in log_chunk else None
+        # Регулярку ответа запускаем, только если запись не оказалась вопросом
+        answer_match = None
+        if not question_match and ANSWER_MARKER in log_chunk:
+            answer_match = A_SEARCH(log_chunk)
+
+        if question_match:
+            # Нашли вопрос пользователя
+            timestamp = question_match.group(1).decode('ascii')
+            # Имена повторяются тысячи раз: интернируем, чтобы все словари делили один объект-ключ
+            username = sys.intern(_decode(question_match.group(2)).strip())
+            question_text = _decode(question_match.group(3))
+            # Сохраняем вопрос вместе с его временной меткой
+            pending_questions[username].append(timestamp, question_text)
+
+        elif answer_match:
+            # Нашли ответ бота
+            timestamp = answer_match.group(1).decode('ascii')
+            username = sys.intern(_decode(answer_match.group(2)).strip())
+            model_used = _decode(answer_match.group(3))
+            token_usage = _decode(answer_match.group(4) or b"")
+            answer_text = _decode(answer_match.group(5))
+
+            # --- УЛУЧШЕННАЯ ЛОГИКА СОПОСТАВЛЕНИЯ ---
+            # Ищем самый последний вопрос, который был задан ДО этого ответа.
+            # Это решает проблему, когда ответы приходят не по порядку или не на все вопросы.
+            # Вопросы отсортированы по времени, поэтому достаточно двоичного поиска.
+            matched_question = pending_questions[username].pop_latest_before(timestamp)
+
+            if matched_question is not None:
+                # Мы нашли подходящий вопрос.
+                question_timestamp, question_text = matched_question
+                # Если ответ выглядит как служебная ошибка/сообщение о лимите —
+                # помечаем его статусом ошибки (текст соберём при записи).
+                # Проверяем только здесь: ответ без вопроса в итог не попадает,
+                # и сканировать его текст незачем.
+                status = DIALOG_ERROR if ERROR_SEARCH(answer_text) else DIALOG_ANSWERED
+                dialogs = all_dialogs[username]
+                if dialogs and question_timestamp < dialogs[-1][0]:
+                    unordered_users.add(username)
+                dialogs.append((question_timestamp, question_text, answer_text, model_used, token_usage, status))
+        else:
+            # Это служебный лог (Token Usage, попытка без подтверждения возраста и т.д.)
+            # Запоминаем его положение, сам текст возьмём из файла при записи
+            service_ranges.append((chunk_start, chunk_end))
 
     print(f"Читаю файл '{input_filename}'...")
 
     try:
-        with open(input_filename, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Разбиваем логи по логам Railway (начинаются с ISO timestamp: YYYY-MM-DDTHH:MM:SS.microseconds Z)
-        # или по логам, начинающимся с YYYY-MM-DD HH:MM:SS
-        # Используем lookahead для разделения, оставляя разделитель в начале каждого лога
-        log_chunks = re.split(r'(?=\d{4}-\d{2}-\d{2}[T ])', content)
-        
-        for log_chunk in log_chunks:
-            if not log_chunk.strip():
-                continue
-                
-            # Каждый log_chunk может быть многострочным
-            question_match = question_pattern.search(log_chunk)
-            answer_match = answer_pattern.search(log_chunk)
-
-            if question_match:
-                # Нашли вопрос пользователя
-                timestamp = question_match.group(1)
-                username = question_match.group(2).strip()
-                question_text = question_match.group(3)
-                # Сохраняем вопрос вместе с его временной меткой
-                pending_questions[username].append((timestamp, question_text))
-
-            elif answer_match:
-                # Нашли ответ бота
-                timestamp = answer_match.group(1)
-                username = answer_match.group(2).strip()
-                model_used = answer_match.group(3)
-                token_usage = answer_match.group(4) or ""
-                answer_text = answer_match.group(5)
-
-                # --- УЛУЧШЕННАЯ ЛОГИКА СОПОСТАВЛЕНИЯ ---
-                # Ищем самый последний вопрос, который был задан ДО этого ответа.
-                # Это решает проблему, когда ответы приходят не по порядку или не на все вопросы.
-                best_match_index = -1
-                for i, (q_ts, q_text) in enumerate(pending_questions[username]):
-                    if q_ts < timestamp:
-                        best_match_index = i
-                    else:
-                        # Вопросы отсортированы по времени, так что дальше можно не искать.
-                        break
-                
-                # Если ответ выглядит как служебная ошибка/сообщение о лимите —
-                # считаем его неответом и перемещаем в блок НЕОТВЕЧЕННЫХ,
-                # чтобы такие пары оказались внизу итогового файла.
-                error_phrases = {
-                    "Хм, чёт у меня какие-то неполадки... Напиши потом.",
-                    "Мля, я заманался с тобой болтать. Приходи в другой раз. (токены закончились, напиши через несколько часов)"
-                }
-                answer_lower = answer_text.lower()
-                is_error_response = any(phrase in answer_text for phrase in error_phrases) or any(k in answer_lower for k in ("токен", "токены", "неполад", "напиши потом"))
-
-                if best_match_index != -1:
-                    # Мы нашли подходящий вопрос. Извлекаем его.
-                    question_timestamp, question_text = pending_questions[username].pop(best_match_index)
-                    if is_error_response:
-                        # Помещаем в общий список с пометкой об ошибке
-                        dialog_entry = (
-                            f"({question_timestamp})\n"
-                            f"👤 Пользователь: {username}\n"
-                            f"❓ Вопрос: {question_text}\n"
-                            f"🤖 Ответ: [ОШИБКА] {answer_text}\n\n"
-                        )
-                        all_dialogs[username].append((question_timestamp, dialog_entry))
-                    else:
-                        # Включаем (token usage: N) если он присутствует в исходном логе
-                        tu_part = f" {token_usage}" if token_usage else ""
-                        dialog_entry = (
-                            f"({question_timestamp})\n"
-                            f"👤 Пользователь: {username}\n"
-                            f"❓ Вопрос: {question_text}\n"
-                            f"🤖 Ответ (модель: {model_used}{tu_part}): {answer_text}\n\n"
-                        )
-                        all_dialogs[username].append((question_timestamp, dialog_entry))
-            else:
-                # Это служебный лог (Token Usage, попытка без подтверждения возраста и т.д.)
-                # Сохраняем его для справочной информации
-                if log_chunk.strip():  # Пропускаем пустые строки
-                    service_logs.append(log_chunk)
-
-        # --- НОВЫЙ ШАГ: Обработка оставшихся вопросов без ответов ---
-        # После обработки всего файла, проверяем, остались ли неотвеченные вопросы.
-        for username, questions in pending_questions.items():
-            if questions:
-                for question_timestamp, question_text in questions:
-                    dialog_entry = (
-                        f"({question_timestamp})\n"
-                        f"👤 Пользователь: {username}\n"
-                        f"❓ Вопрос: {question_text}\n"
-                        f"🤖 Ответ: [НЕТ ОТВЕТА]\n\n"
-                    )
-                    # Добавляем в основной список вместе с остальными диалогами
-                    all_dialogs[username].append((question_timestamp, dialog_entry))
-
-        # --- ФИНАЛЬНЫЙ ШАГ: Сборка и запись результата ---
-        # Группируем все диалоги по пользователям и сортируем
-        final_output = []
-        total_dialogs = 0
-
-        sorted_usernames = sorted(all_dialogs.keys())
-        for i, username in enumerate(sorted_usernames):
-            # Добавляем заголовок с именем пользователя
-            final_output.append(f"\n{'*'*50}\n")
-            final_output.append(f"👤 ПОЛЬЗОВАТЕЛЬ: {username}\n")
-            final_output.append(f"{'*'*50}\n\n")
-            
-            # Сортируем диалоги пользователя по времени
-            dialogs = sorted(all_dialogs[username], key=lambda x: x[0])
-            final_output.extend([dialog[1] for dialog in dialogs])
-            total_dialogs += len(dialogs)
-
-        # Добавляем служебные логи в конец (для справки)
-        if service_logs:
-            final_output.append(f"\n\n{'='*60}\n")
-            final_output.append("📋 СЛУЖЕБНЫЕ ЛОГИ (Service Logs - не вошли в диалоги)\n")
-            final_output.append(f"{'='*60}\n\n")
-            final_output.extend(service_logs)
-
-        print(f"Обработка завершена. Найдено {total_dialogs} диалогов, {len(service_logs)} служебных логов.")
-
-        with open(output_filename, 'w', encoding='utf-8') as f:
-            f.writelines(final_output)
-        
-        print(f"Результат сохранен в файл '{output_filename}'.")
+        # Отображаем файл в память (mmap) и ищем начала записей одним проходом
+        # finditer на стороне C, без Python-цикла по строкам. Запись — это всё от строки
+        # с временной меткой (Railway: YYYY-MM-DDTHH:MM:SS..., или обычный лог:
+        # YYYY-MM-DD HH:MM:SS) до следующей такой строки. Память не зависит от размера файла.
+        # Отображение держим открытым до конца записи: служебные логи копируются прямо из него.
+        with open(input_filename, 'rb') as f, _map_file(f) as buf:
+            chunk_start = 0
+            for match in _CHUNK_START.finditer(buf):
+                chunk_end = match.start()
+                if chunk_end:
+                    _process_chunk(buf, chunk_start, chunk_end)
+                    chunk_start = chunk_end
+            # Не забываем последнюю запись
+            _process_chunk(buf, chunk_start, len(buf))
+
+            # --- НОВЫЙ ШАГ: Обработка оставшихся вопросов без ответов ---
+            # После обработки всего файла, проверяем, остались ли неотвеченные вопросы.
+            for username, questions in pending_questions.items():
+                remaining = questions.remaining()
+                if remaining:
+                    # Очередь вопросов уже упорядочена по времени
+                    unanswered_dialogs[username] = [
+                        (question_timestamp, question_text, "", "", "", DIALOG_NO_ANSWER)
+                        for question_timestamp, question_text in remaining
+                    ]
+
+            # --- ФИНАЛЬНЫЙ ШАГ: Сборка и запись результата ---
+            # Диалоги форматируются и пишутся в файл сразу, без промежуточного списка строк
+            total_dialogs = sum(map(len, all_dialogs.values())) + sum(map(len, unanswered_dialogs.values()))
+            print(f"Обработка завершена. Найдено {total_dialogs} диалогов, {len(service_ranges)} служебных логов.")
+
+            sorted_usernames = sorted(all_dialogs.keys() | unanswered_dialogs.keys())
+            # Файл пишем в двоичном режиме: служебные логи уходят в него байтами без перекодирования
+            with open(output_filename, 'wb') as out:
+                for username in sorted_usernames:
+                    # Заголовок с именем пользователя
+                    header = f"\n{SEP}\n👤 ПОЛЬЗОВАТЕЛЬ: {username}\n{SEP}\n\n"
+
+                    # Диалоги пользователя уже идут по времени; сортируем только если порядок нарушился
+                    dialogs = all_dialogs.get(username, [])
+                    if username in unordered_users:
+                        dialogs.sort(key=itemgetter(0))
+                    # Вопросы без ответа вливаем слиянием двух упорядоченных списков
+                    tail = unanswered_dialogs.get(username)
+                    if tail:
+                        dialogs = heapq.merge(dialogs, tail, key=itemgetter(0))
+                    # Один вызов write() на весь блок пользователя
+                    out.write("".join((header, *(_format_dialog(username, entry) for entry in dialogs))).encode('utf-8'))
+
+                # Добавляем служебные логи в конец (для справки)
+                if service_ranges:
+                    out.write(f"\n\n{SERVICE_SEP}\n📋 СЛУЖЕБНЫЕ ЛОГИ (Service Logs - не вошли в диалоги)\n{SERVICE_SEP}\n\n".encode('utf-8'))
+                    for range_start, range_end in service_ranges:
+                        out.write(_normalize_newlines(buf[range_start:range_end]))
+
+            print(f"Результат сохранен в файл '{output_filename}'.")
 
     except FileNotFoundError:
         print(f"Ошибка: Файл '{input_filename}' не найден. Убедитесь, что он находится в этой же папке.")
@@ -166,6 +287,23 @@ def sort_log_file(input_filename: str, output_filename: str):
         print(f"Произошла непредвиденная ошибка: {e}")
 
 
+def _sort_worker(paths: tuple[str, str]) -> None:
+    """Точка входа процесса-воркера для sort_many."""
+    input_filename, output_filename = paths
+    sort_log_file(input_filename, output_filename)
+
+
+def sort_many(pairs: list[tuple[str, str]], workers: Optional[int] = None) -> None:
+    """
+    Обрабатывает несколько лог-файлов параллельно, по одному файлу на процесс.
+    pairs — список пар (входной файл, выходной файл); workers — число процессов
+    (по умолчанию по количеству ядер).
+    Разбор упирается в CPU, поэтому используем процессы, а не потоки (GIL).
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_sort_worker, pairs))
+
+
 if __name__ == "__main__":
     # Определяем директорию, в которой находится сам скрипт.
     # Это делает скрипт независимым от того, из какой папки его запускают.
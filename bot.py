@@ -1,6 +1,8 @@
+import asyncio
 import logging
 import sys
 import re
+from datetime import timedelta
 
 import os
 # --- НАСТРОЙКА ЛОГИРОВАНИЯ ---
@@ -29,12 +31,13 @@ for logger_name in ["handlers.echo", "handlers.support_command", "httpx", "servi
 
 
 # Удаляем дублирующийся импорт, оставляем один более полный
-from telegram.ext import Application, PicklePersistence
+from telegram.ext import Application, PicklePersistence, ContextTypes
 from telegram import Update
 from telegram import BotCommand
 
 # Импортируем новую функцию для инициализации БД
-from database import init_db
+from database import init_db, purge_old_usage
+from services.lore_search import preload_lore_engine
 # Импортируем токен из централизованной конфигурации
 from config import BOT_TOKEN
 
@@ -82,10 +85,15 @@ class HttpxLogFilter(logging.Filter):
 httpx_logger = logging.getLogger("httpx")
 httpx_logger.addFilter(HttpxLogFilter())
 
+async def purge_usage_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая очистка старых записей usage (выполняется в отдельном потоке, чтобы не блокировать бота)."""
+    await asyncio.to_thread(purge_old_usage)
+
 async def post_init(application: Application) -> None:
     """
     Эта функция выполняется один раз после запуска бота.
-    Она устанавливает список команд, которые будут видны в кнопке меню.
+    Она устанавливает список команд, которые будут видны в кнопке меню,
+    и планирует ежедневную очистку старых записей БД.
     """
     commands = [
         BotCommand("start", "Перезапустить бота"),
@@ -95,6 +103,14 @@ async def post_init(application: Application) -> None:
     await application.bot.set_my_commands(commands)
     logging.getLogger(__name__).info("Команды в меню успешно установлены.")
 
+    # Очистка старых записей: сразу после запуска и далее раз в сутки.
+    # JobQueue доступен только при установленном python-telegram-bot[job-queue].
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(purge_usage_job, interval=timedelta(days=1), first=0, name="purge_old_usage")
+    else:
+        logging.getLogger(__name__).warning("JobQueue недоступен, очистка старых записей БД выполняется только при запуске.")
+        await asyncio.to_thread(purge_old_usage)
+
 def main() -> None:
     """Запуск бота."""
     logger = logging.getLogger(__name__)
@@ -103,6 +119,9 @@ def main() -> None:
     # Инициализируем базу данных для логов токенов
     init_db()
 
+    # Лор загружаем в фоне, пока бот подключается к Telegram
+    preload_lore_engine()
+
     # Временный диагностический код удалён (db_watcher).
 
     # Определяем путь к папке с данными
@@ -122,6 +141,9 @@ def main() -> None:
         .token(BOT_TOKEN)
         .persistence(persistence)
         .post_init(post_init)
+        # Обрабатываем до 8 апдейтов одновременно: медленный ответ ИИ в одном чате
+        # не задерживает остальные. Порядок внутри чата сохраняют блокировки из handlers.utils.
+        .concurrent_updates(8)
         .build()
     )
 
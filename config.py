@@ -63,11 +63,12 @@ try:
     # Флаг режима обслуживания. По умолчанию выключен.
     BOT_MAINTENANCE = get_env_var("BOT_MAINTENANCE", is_bool=True, default=False)
     
-    # Список заблокированных пользователей (ID)
-    BLACKLIST = [
+    # Список заблокированных пользователей (ID).
+    # frozenset: проверяется декоратором check_blacklist на каждом апдейте, поиск по хэшу O(1).
+    BLACKLIST = frozenset([
         # 123456789,  # @username - причина блокировки
         6159954766 #тестовый
-    ]
+    ])
     
     # Загружаем системный промпт из файла, а не из .env
     SYSTEM_PROMPT = load_prompt_from_file("system_prompt.txt")
@@ -77,4 +78,5 @@ except (ValueError, FileNotFoundError):
     exit()
 
 # Список ID чатов, где боту разрешено работать (реагировать на баны).
-ALLOWED_GROUP_IDS = get_env_var("ALLOWED_GROUP_IDS", is_list_of_int=True, default=[])
+# frozenset: принадлежность проверяется на каждом сообщении в группах, поиск по хэшу O(1).
+ALLOWED_GROUP_IDS = frozenset(get_env_var("ALLOWED_GROUP_IDS", is_list_of_int=True, default=[]))
@@ -1,7 +1,13 @@
 import sqlite3
 import logging
+import threading
+import atexit
+import functools
+from collections import deque, Counter, defaultdict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
+import time
 from typing import Optional
 
 logger = logging.getLogger(__name__)
@@ -18,6 +24,328 @@ os.makedirs(DATA_DIR, exist_ok=True)
 # Основная БД приложения теперь ponchik_db (SQLite файл)
 DB_NAME = os.path.join(DATA_DIR, "ponchik_db.db")
 
+# Настройки соединения SQLite.
+# journal_mode=WAL сохраняется в самом файле БД, остальные PRAGMA действуют только
+# на текущее соединение, поэтому выставляем их при каждом подключении.
+# synchronous=NORMAL в режиме WAL не делает fsync на каждый коммит — только на checkpoint.
+_CONNECTION_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+    PRAGMA busy_timeout=5000;
+"""
+
+
+# Одно соединение на весь процесс: не переоткрываем .db/-wal/-shm на каждый запрос.
+# Доступ к нему сериализуем блокировкой, чтобы соединением можно было пользоваться из любого потока.
+_CONN: Optional[sqlite3.Connection] = None
+_LOCK = threading.Lock()
+
+
+def _get_conn() -> sqlite3.Connection:
+    """Лениво открывает общее соединение с БД и один раз применяет к нему PRAGMA. Вызывать под _LOCK."""
+    global _CONN
+    if _CONN is None:
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        conn.executescript(_CONNECTION_PRAGMAS)
+        _CONN = conn
+    return _CONN
+
+
+@contextmanager
+def _connect():
+    """
+    Выдаёт общее соединение под блокировкой.
+    Как и `with sqlite3.connect(...)`, фиксирует транзакцию при выходе или откатывает её при ошибке.
+    """
+    with _LOCK:
+        conn = _get_conn()
+        with conn:
+            yield conn
+
+
+# --- Отложенная запись в usage ---
+# log_usage_to_db только кладёт строку в очередь, а фоновый поток сбрасывает её в БД
+# пачкой каждые _USAGE_FLUSH_INTERVAL секунд или как только накопится _USAGE_FLUSH_BATCH строк.
+# Так вместо коммита на каждое сообщение получаем один коммит на пачку.
+# Элемент очереди — (tg_id, строка для usage): счетчик total_requests обновляется в той же транзакции.
+_USAGE_FLUSH_INTERVAL = 0.5
+_USAGE_FLUSH_BATCH = 64
+_INSERT_USAGE_SQL = (
+    "INSERT INTO usage (timestamp, day, username, lore_chunks_sent, prompt_tokens, completion_tokens, total_tokens, user_message, ai_response, model_name) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+# Инкремент сводной таблицы daily_user_stats (см. _migrate_schema)
+_UPSERT_DAILY_STATS_SQL = """
+    INSERT INTO daily_user_stats (day, username, model_name, requests, total_tokens)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(day, username, model_name) DO UPDATE SET
+        requests = requests + excluded.requests,
+        total_tokens = total_tokens + excluded.total_tokens
+"""
+# Если БД долго недоступна, очередь не должна расти без предела: сверх _USAGE_MAX_PENDING
+# строк самые старые отбрасываются. Пачка, которую не удалось записать из-за блокировки БД,
+# возвращается в очередь, но не больше _USAGE_MAX_FLUSH_ATTEMPTS раз подряд.
+_USAGE_MAX_PENDING = 10_000
+_USAGE_MAX_FLUSH_ATTEMPTS = 10
+_pending_usage: deque = deque()
+_usage_flush_failures = 0
+_usage_dropped = 0
+_usage_flush_event = threading.Event()
+_usage_writer_thread: Optional[threading.Thread] = None
+_usage_writer_lock = threading.Lock()
+
+
+def _drop_oldest_pending():
+    """Отбрасывает самые старые строки, если очередь превысила _USAGE_MAX_PENDING."""
+    global _usage_dropped
+    overflow = len(_pending_usage) - _USAGE_MAX_PENDING
+    if overflow <= 0:
+        return
+    for _ in range(overflow):
+        try:
+            _pending_usage.popleft()
+        except IndexError:
+            break
+    # Предупреждаем о первой потере и дальше раз в 1000 строк, чтобы не засорять лог
+    previous = _usage_dropped
+    _usage_dropped += overflow
+    if previous == 0 or previous // 1000 != _usage_dropped // 1000:
+        logger.warning(f"Очередь записи usage переполнена: отброшено старых строк всего {_usage_dropped}.")
+
+
+def _write_usage_batch(taken: list):
+    """
+    Записывает строки usage, инкременты total_requests и сводку daily_user_stats одной транзакцией.
+    Инкременты суммируются по tg_id, сводка — по (day, username, model_name),
+    так что на каждый ключ приходится один UPDATE/UPSERT.
+    """
+    rows = []
+    request_counts = Counter()
+    # (day, username, model_name) -> [запросов, токенов]
+    daily_totals = defaultdict(lambda: [0, 0])
+    for tg_id, row in taken:
+        rows.append(row)
+        request_counts[tg_id] += 1
+        totals = daily_totals[(row[1], row[2], row[9])]
+        totals[0] += 1
+        totals[1] += row[6]
+    with _connect() as conn:
+        conn.executemany(_INSERT_USAGE_SQL, rows)
+        conn.executemany(
+            "UPDATE users SET total_requests = total_requests + ? WHERE tg_id = ?",
+            [(delta, tg_id) for tg_id, delta in request_counts.items()]
+        )
+        conn.executemany(
+            _UPSERT_DAILY_STATS_SQL,
+            [(day, username, model_name, requests, tokens) for (day, username, model_name), (requests, tokens) in daily_totals.items()]
+        )
+
+
+def _flush_usage():
+    """
+    Записывает все накопленные строки usage одной транзакцией (см. _write_usage_batch).
+    - БД занята/заблокирована (OperationalError): пачка возвращается в очередь,
+      после _USAGE_MAX_FLUSH_ATTEMPTS неудач подряд — отбрасывается.
+    - Другая ошибка SQLite (плохая строка, повреждённый файл): повтор не поможет,
+      поэтому строки пишутся по одной и теряются только те, что не записались.
+    """
+    global _usage_flush_failures
+    taken = []
+    try:
+        while True:
+            taken.append(_pending_usage.popleft())
+    except IndexError:
+        pass
+    if not taken:
+        return
+
+    try:
+        _write_usage_batch(taken)
+        _usage_flush_failures = 0
+    except sqlite3.OperationalError as e:
+        _usage_flush_failures += 1
+        if _usage_flush_failures < _USAGE_MAX_FLUSH_ATTEMPTS:
+            # Транзакция откатилась целиком — возвращаем строки в начало очереди, запишем в следующий раз
+            _pending_usage.extendleft(reversed(taken))
+            _drop_oldest_pending()
+            logger.error(f"Ошибка при записи в базу данных SQLite (попытка {_usage_flush_failures}, строк в очереди: {len(_pending_usage)}): {e}")
+        else:
+            _usage_flush_failures = 0
+            logger.error(f"Не удалось записать usage {_USAGE_MAX_FLUSH_ATTEMPTS} раз подряд, отброшено строк: {len(taken)}. Последняя ошибка: {e}")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при записи пачки usage в базу данных SQLite, записываю строки по одной: {e}")
+        lost = 0
+        for item in taken:
+            try:
+                _write_usage_batch([item])
+            except sqlite3.Error as row_error:
+                lost += 1
+                logger.debug(f"Строка usage не записана: {row_error}")
+        if lost:
+            logger.error(f"Не удалось записать строк usage: {lost} из {len(taken)}.")
+
+
+def _usage_writer():
+    """Цикл фонового потока записи usage."""
+    while True:
+        try:
+            _usage_flush_event.wait(_USAGE_FLUSH_INTERVAL)
+            _usage_flush_event.clear()
+            _flush_usage()
+        except Exception:
+            # Поток один на процесс и не перезапускается — любая ошибка не должна его останавливать
+            logger.exception("Ошибка в фоновом потоке записи usage")
+
+
+def _ensure_usage_writer():
+    """Запускает фоновый поток записи при первом обращении."""
+    global _usage_writer_thread
+    if _usage_writer_thread is not None:
+        return
+    with _usage_writer_lock:
+        if _usage_writer_thread is None:
+            thread = threading.Thread(target=_usage_writer, name="usage-writer", daemon=True)
+            thread.start()
+            _usage_writer_thread = thread
+
+
+# Дописываем хвост очереди при штатном завершении процесса
+atexit.register(_flush_usage)
+
+
+# Кэш текущей даты: (начало дня, начало следующего дня, 'YYYY-MM-DD').
+# Строку даты пересчитываем только при смене суток, а не на каждое сообщение.
+_day_cache = (0.0, 0.0, "")
+
+
+def _day_for(ts: float) -> str:
+    """Возвращает локальную дату 'YYYY-MM-DD' для unix-времени ts."""
+    global _day_cache
+    day_start, day_end, day_str = _day_cache
+    if day_start <= ts < day_end:
+        return day_str
+    local = time.localtime(ts)
+    day_str = time.strftime("%Y-%m-%d", local)
+    day_start = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+    day_end = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+    _day_cache = (day_start, day_end, day_str)
+    return day_str
+
+
+# Схема таблицы usage. timestamp хранится как INTEGER (unix-время в секундах):
+# сравнение чисел дешевле разбора строки, а диапазонные условия обслуживаются индексом.
+_USAGE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        lore_chunks_sent INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        completion_tokens INTEGER NOT NULL,
+        total_tokens INTEGER NOT NULL,
+        user_message TEXT NOT NULL,
+        ai_response TEXT NOT NULL,
+        model_name TEXT NOT NULL,
+        day TEXT
+    )
+"""
+_USAGE_COLUMNS = "id, timestamp, username, lore_chunks_sent, prompt_tokens, completion_tokens, total_tokens, user_message, ai_response, model_name, day"
+
+
+# Текущая версия схемы БД. Увеличивать при каждом изменении схемы в _migrate_schema.
+SCHEMA_VERSION = 2
+
+
+def _migrate_schema(cursor: sqlite3.Cursor):
+    """Создаёт таблицы и приводит схему старых БД к текущей версии SCHEMA_VERSION."""
+    # Таблица usage (сохраняем для совместимости с предыдущей логикой)
+    cursor.execute(_USAGE_TABLE_SQL.format(table="usage"))
+
+    # Новая таблица пользователей
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nickname TEXT,
+            tg_username TEXT,
+            tg_id INTEGER UNIQUE,
+            activation_date TEXT,
+            total_requests INTEGER DEFAULT 0
+        )
+    """)
+
+    # --- Проверка и добавление колонки для обратной совместимости ---
+    # Получаем информацию о столбцах в таблице
+    cursor.execute("PRAGMA table_info(usage)")
+    column_types = {column[1]: column[2].upper() for column in cursor.fetchall()}
+    columns = list(column_types)
+    # Если колонки 'model_name' нет, добавляем её
+    if 'model_name' not in columns:
+        logger.info("Обновление схемы БД: добавляется колонка 'model_name'...")
+        # Добавляем с дефолтным значением, чтобы не было ошибок на старых данных
+        cursor.execute("ALTER TABLE usage ADD COLUMN model_name TEXT NOT NULL DEFAULT 'unknown'")
+        logger.info("Колонка 'model_name' успешно добавлена.")
+    # Колонка 'day' (YYYY-MM-DD) хранит дату записи отдельно, чтобы запросы статистики
+    # фильтровали по индексу, а не вычисляли date(timestamp) для каждой строки
+    if 'day' not in columns:
+        logger.info("Обновление схемы БД: добавляется колонка 'day'...")
+        cursor.execute("ALTER TABLE usage ADD COLUMN day TEXT")
+        cursor.execute("UPDATE usage SET day = date(timestamp)")
+        logger.info("Колонка 'day' успешно добавлена.")
+    # Старые БД хранят timestamp строкой 'YYYY-MM-DD HH:MM:SS' (локальное время).
+    # Тип колонки в SQLite не меняется через ALTER, поэтому пересобираем таблицу.
+    timestamp_migrated = column_types.get('timestamp') == 'TEXT'
+    if timestamp_migrated:
+        logger.info("Обновление схемы БД: перевод 'timestamp' в INTEGER (unix-время)...")
+        # Строки хранились в локальном времени: модификатор 'utc' переводит их в UTC перед '%s'
+        select_columns = _USAGE_COLUMNS.replace("timestamp", "CAST(strftime('%s', timestamp, 'utc') AS INTEGER)", 1)
+        cursor.execute(_USAGE_TABLE_SQL.format(table="usage_new"))
+        cursor.execute(f"INSERT INTO usage_new ({_USAGE_COLUMNS}) SELECT {select_columns} FROM usage")
+        cursor.execute("DROP TABLE usage")
+        cursor.execute("ALTER TABLE usage_new RENAME TO usage")
+        logger.info("Колонка 'timestamp' успешно переведена в INTEGER.")
+
+    # Индексы под запросы статистики: фильтр по дню + группировка по пользователю/модели.
+    # total_tokens в индексе позволяет считать SUM без обращения к самой таблице.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_day_user ON usage(day, username, total_tokens)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_day_model ON usage(day, model_name, total_tokens)")
+    # Индекс по времени для удаления старых записей диапазоном
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_ts ON usage(timestamp)")
+
+    # Сводка по дням (версия 2): запросы статистики читают её вместо сырых строк usage,
+    # то есть O(пользователей за день), а не O(сообщений за день).
+    # Пополняется инкрементально в _flush_usage, при создании заполняется из usage.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_user_stats'")
+    daily_stats_created = cursor.fetchone() is None
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_user_stats (
+            day TEXT NOT NULL,
+            username TEXT NOT NULL,
+            model_name TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, username, model_name)
+        )
+    """)
+    if daily_stats_created:
+        logger.info("Обновление схемы БД: заполняется сводная таблица 'daily_user_stats'...")
+        cursor.execute("""
+            INSERT INTO daily_user_stats (day, username, model_name, requests, total_tokens)
+            SELECT day, username, model_name, COUNT(*), SUM(total_tokens)
+            FROM usage
+            WHERE day IS NOT NULL
+            GROUP BY day, username, model_name
+        """)
+        logger.info("Сводная таблица 'daily_user_stats' заполнена.")
+
+    if 'day' not in columns or timestamp_migrated or daily_stats_created:
+        # Обновляем статистику планировщика после появления новых индексов
+        cursor.execute("ANALYZE")
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
 def init_db():
     """
     Инициализирует базу данных.
@@ -34,54 +362,19 @@ def init_db():
             db_size = 0
         logger.info(f"Инициализация БД: path={DB_NAME}, exists={db_exists}, size={db_size} bytes, DATA_DIR={DATA_DIR}")
         logger.info(f"Env markers: RAILWAY_ENVIRONMENT={'RAILWAY_ENVIRONMENT' in os.environ}, PORT={os.environ.get('PORT')}, RAILWAY_STATIC_URL={'RAILWAY_STATIC_URL' in os.environ}")
-        with sqlite3.connect(DB_NAME) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            # Таблица usage (сохраняем для совместимости с предыдущей логикой)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS usage (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT NOT NULL,
-                    username TEXT NOT NULL,
-                    lore_chunks_sent INTEGER NOT NULL,
-                    prompt_tokens INTEGER NOT NULL,
-                    completion_tokens INTEGER NOT NULL,
-                    total_tokens INTEGER NOT NULL,
-                    user_message TEXT NOT NULL,
-                    ai_response TEXT NOT NULL,
-                    model_name TEXT NOT NULL
-                )
-            """)
-
-            # Новая таблица пользователей
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    nickname TEXT,
-                    tg_username TEXT,
-                    tg_id INTEGER UNIQUE,
-                    activation_date TEXT,
-                    total_requests INTEGER DEFAULT 0
-                )
-            """)
-
-            # --- Проверка и добавление колонки для обратной совместимости ---
-            # Получаем информацию о столбцах в таблице
-            cursor.execute("PRAGMA table_info(usage)")
-            columns = [column[1] for column in cursor.fetchall()]
-            # Если колонки 'model_name' нет, добавляем её
-            if 'model_name' not in columns:
-                logger.info("Обновление схемы БД: добавляется колонка 'model_name'...")
-                # Добавляем с дефолтным значением, чтобы не было ошибок на старых данных
-                cursor.execute("ALTER TABLE usage ADD COLUMN model_name TEXT NOT NULL DEFAULT 'unknown'")
-                logger.info("Колонка 'model_name' успешно добавлена.")
-
+            # Версия схемы хранится в заголовке файла БД (PRAGMA user_version).
+            # Если БД уже приведена к текущей схеме, проверки столбцов и миграции пропускаем.
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] >= SCHEMA_VERSION:
+                logger.info(f"Схема БД актуальна (версия {SCHEMA_VERSION}), миграции не требуются.")
+            else:
+                _migrate_schema(cursor)
             conn.commit()
         logger.info(f"База данных '{DB_NAME}' успешно инициализирована.")
-        # После инициализации выполняем очистку старых записей (по умолчанию сохраняем до и включая 'позавчера')
-        try:
-            purge_old_usage()
-        except Exception as e:
-            logger.error(f"Ошибка при запуске очистки старых записей: {e}")
+        # Очистка старых записей (purge_old_usage) больше не вызывается отсюда:
+        # бот запускает её по расписанию (см. post_init в bot.py)
     except sqlite3.Error as e:
         logger.critical(f"Ошибка при инициализации базы данных SQLite: {e}")
         raise
@@ -94,30 +387,32 @@ def log_usage_to_db(tg_id: int, username: str, user_message: str, usage_data, ai
     if not usage_data:
         return
 
-    # --- Шаг 1: Логирование в таблицу 'usage' ---
-    try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO usage (timestamp, username, lore_chunks_sent, prompt_tokens, completion_tokens, total_tokens, user_message, ai_response, model_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (
-                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    username,
-                    lore_chunks_count,
-                    usage_data.prompt_tokens,
-                    usage_data.completion_tokens,
-                    usage_data.total_tokens,
-                    user_message,
-                    ai_response,
-                    model_name
-                )
-            )
-            conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при записи в базу данных SQLite: {e}")
+    # --- Логирование в таблицу 'usage' ---
+    # Строка уходит в очередь, в БД её запишет фоновый поток вместе с остальными.
+    # Там же, в одной транзакции с INSERT, увеличится счетчик 'total_requests'.
+    now = time.time()
+    _pending_usage.append((tg_id, (
+        int(now),
+        _day_for(now),
+        username,
+        lore_chunks_count,
+        # API может вернуть None вместо числа — в БД и сводку пишем 0
+        usage_data.prompt_tokens or 0,
+        usage_data.completion_tokens or 0,
+        usage_data.total_tokens or 0,
+        user_message,
+        ai_response,
+        model_name
+    )))
+    _drop_oldest_pending()
+    _bump_usage_version()
+    _ensure_usage_writer()
+    if len(_pending_usage) >= _USAGE_FLUSH_BATCH:
+        _usage_flush_event.set()
+
 
-    # --- Шаг 2: Инкремент общего счетчика запросов ---
-    increment_user_requests(tg_id=tg_id)
+# RETURNING поддерживается начиная с SQLite 3.35
+_SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
 
 def create_or_update_user(nickname: Optional[str], tg_username: Optional[str], tg_id: Optional[int], activation_date: Optional[str] = None):
@@ -126,27 +421,24 @@ def create_or_update_user(nickname: Optional[str], tg_username: Optional[str], t
         return None
 
     if activation_date is None:
-        activation_date = datetime.now().strftime("%Y-%m-%d")
+        activation_date = _day_for(time.time())
 
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            # Пытаемся вставить нового пользователя, если tg_id уникален
-            cursor.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-            row = cursor.fetchone()
-            if row:
-                # Обновляем данные
-                cursor.execute(
-                    "UPDATE users SET nickname = ?, tg_username = ? WHERE tg_id = ?",
-                    (nickname, tg_username, tg_id)
-                )
+            # Один атомарный UPSERT вместо SELECT + INSERT/UPDATE + SELECT:
+            # новый пользователь вставляется, у существующего обновляются nickname/tg_username
+            upsert_sql = """
+                INSERT INTO users (nickname, tg_username, tg_id, activation_date, total_requests)
+                VALUES (?, ?, ?, ?, 0)
+                ON CONFLICT(tg_id) DO UPDATE SET nickname = excluded.nickname, tg_username = excluded.tg_username
+            """
+            params = (nickname, tg_username, tg_id, activation_date)
+            if _SUPPORTS_RETURNING:
+                cursor.execute(upsert_sql + " RETURNING *", params)
             else:
-                cursor.execute(
-                    "INSERT INTO users (nickname, tg_username, tg_id, activation_date, total_requests) VALUES (?, ?, ?, ?, ?)",
-                    (nickname, tg_username, tg_id, activation_date, 0)
-                )
-            conn.commit()
-            cursor.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
+                cursor.execute(upsert_sql, params)
+                cursor.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
             r = cursor.fetchone()
             if r:
                 cols = [d[0] for d in cursor.description]
@@ -156,11 +448,29 @@ def create_or_update_user(nickname: Optional[str], tg_username: Optional[str], t
     return None
 
 
+def _fetch_columns(cursor: sqlite3.Cursor, columns: tuple[str, ...]) -> dict[str, list]:
+    """
+    Возвращает результат запроса по колонкам: {имя_колонки: [значения...]}.
+    Строки транспонируются одним zip(*rows), без создания объекта на каждую строку.
+    Порядок columns должен совпадать с порядком колонок в SELECT.
+    """
+    rows = cursor.fetchall()
+    if not rows:
+        return _empty_columns(columns)
+    return {name: list(values) for name, values in zip(columns, zip(*rows))}
+
+
+def _empty_columns(columns: tuple[str, ...]) -> dict[str, list]:
+    """Пустой результат в колоночном формате."""
+    return {name: [] for name in columns}
+
+
 def get_user_by_tg_id(tg_id: int) -> Optional[dict]:
+    _flush_usage()  # Счетчик total_requests обновляется вместе с отложенной записью usage
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             cursor.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
@@ -169,119 +479,202 @@ def get_user_by_tg_id(tg_id: int) -> Optional[dict]:
         return None
 
 
-def increment_user_requests(tg_id: int, delta: int = 1):
-    try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE users SET total_requests = total_requests + ? WHERE tg_id = ?", (delta, tg_id))
-            conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Ошибка при обновлении счетчика запросов пользователя: {e}")
+_USER_COLUMNS = ("nickname", "tg_username", "tg_id", "activation_date", "total_requests")
 
 
-def get_all_users() -> list[dict]:
+def get_all_users() -> dict[str, list]:
+    """
+    Возвращает всех пользователей, отсортированных по total_requests, в колоночном формате:
+    {'nickname': [...], 'tg_username': [...], 'tg_id': [...], 'activation_date': [...], 'total_requests': [...]}
+    """
+    _flush_usage()
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT nickname, tg_username, tg_id, activation_date, total_requests FROM users ORDER BY total_requests DESC")
-            return [dict(r) for r in cursor.fetchall()]
+        with _connect() as conn:
+            cursor = conn.execute(f"SELECT {', '.join(_USER_COLUMNS)} FROM users ORDER BY total_requests DESC")
+            return _fetch_columns(cursor, _USER_COLUMNS)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении списка пользователей: {e}")
-        return []
+        return _empty_columns(_USER_COLUMNS)
+
+
+# Сколько строк удалять за одну транзакцию в purge_old_usage.
+# Короткие транзакции не раздувают WAL и не держат блокировку записи надолго.
+_PURGE_BATCH_SIZE = 1000
 
 
 def purge_old_usage(retention_days: int = 2) -> int:
     """
-    Удаляет записи из таблицы `usage`, у которых дата(timestamp) строго меньше чем
+    Удаляет записи из таблицы `usage`, у которых дата записи строго меньше чем
     (сегодня - retention_days). По умолчанию retention_days=2 — это означает,
     что сохраняются записи за сегодня, вчера и позавчера; всё, что старше позавчера,
     будет удалено.
 
+    Удаление идёт пачками по _PURGE_BATCH_SIZE строк с коммитом после каждой,
+    после чего WAL-файл усекается checkpoint'ом.
+
     Возвращает количество удалённых записей.
     """
+    _flush_usage()
     try:
-        cutoff_date = (datetime.now().date() - timedelta(days=retention_days)).strftime("%Y-%m-%d")
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            # Удаляем строки с датой меньше cutoff_date
-            cursor.execute("DELETE FROM usage WHERE date(timestamp) < ?", (cutoff_date,))
-            deleted = cursor.rowcount if cursor.rowcount is not None else 0
-            conn.commit()
+        cutoff = datetime.now().date() - timedelta(days=retention_days)
+        cutoff_date = cutoff.strftime("%Y-%m-%d")
+        # Полночь cutoff_date по локальному времени в unix-секундах
+        cutoff_ts = int(time.mktime(cutoff.timetuple()))
+        deleted = 0
+        _bump_usage_version()
+        while True:
+            with _connect() as conn:
+                # Удаляем строки с датой меньше cutoff_date (диапазон по индексу idx_usage_ts).
+                # DELETE ... LIMIT есть не во всех сборках SQLite, поэтому ограничиваем через подзапрос.
+                cursor = conn.execute(
+                    "DELETE FROM usage WHERE id IN (SELECT id FROM usage WHERE timestamp < ? LIMIT ?)",
+                    (cutoff_ts, _PURGE_BATCH_SIZE)
+                )
+                batch_deleted = cursor.rowcount if cursor.rowcount is not None else 0
+            deleted += batch_deleted
+            if batch_deleted < _PURGE_BATCH_SIZE:
+                break
+        # Сводка по дням хранится столько же, сколько и сами записи
+        with _connect() as conn:
+            conn.execute("DELETE FROM daily_user_stats WHERE day < ?", (cutoff_date,))
+        if deleted:
+            # Возвращаем место, занятое WAL-файлом после удаления
+            with _LOCK:
+                _get_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
         logger.info(f"Очистка БД: удалено {deleted} записей из 'usage' старше чем {cutoff_date}.")
         return deleted
     except sqlite3.Error as e:
         logger.error(f"Ошибка при очистке старых записей usage: {e}")
         return 0
 
-def get_stats_for_date(date_str: str) -> list[dict]:
+def backup_db(dest_path: str) -> bool:
+    """
+    Копирует БД в файл dest_path штатным механизмом SQLite (постраничное копирование на стороне C).
+    В отличие от чтения самого файла, копия учитывает данные, ещё лежащие в WAL.
+    Возвращает True при успехе.
+    """
+    _flush_usage()
+    try:
+        dest = sqlite3.connect(dest_path)
+        try:
+            with _LOCK:
+                _get_conn().backup(dest)
+        finally:
+            dest.close()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при создании копии базы данных: {e}")
+        return False
+
+# --- Кэш запросов статистики ---
+# Админ обычно запрашивает одну и ту же дату несколько раз подряд, поэтому результаты
+# кэшируются на _STATS_CACHE_TTL секунд. Любое изменение usage увеличивает _usage_version,
+# и кэш с устаревшей версией сбрасывается — свежие данные видны сразу.
+_STATS_CACHE_TTL = 30
+_usage_version = 0
+
+
+def _bump_usage_version():
+    """Помечает закэшированную статистику устаревшей."""
+    global _usage_version
+    _usage_version += 1
+
+
+def _copy_stats(result: dict) -> dict:
+    """Копия результата для вызывающего: колонки-списки копируются, чтобы их изменение не портило кэш."""
+    return {key: list(value) if isinstance(value, list) else value for key, value in result.items()}
+
+
+def _stats_cache(func):
+    """
+    Декоратор: кэширует результат по аргументам с TTL и сбросом при изменении usage.
+    Каждый вызов получает свою копию (см. _copy_stats), сам кэш наружу не отдаётся.
+    """
+    cache = {}
+    cache_version = [_usage_version]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if cache_version[0] != _usage_version:
+            cache.clear()
+            cache_version[0] = _usage_version
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        cached = cache.get(key)
+        if cached is not None and now - cached[0] < _STATS_CACHE_TTL:
+            return _copy_stats(cached[1])
+        result = func(*args, **kwargs)
+        cache[key] = (now, result)
+        return _copy_stats(result)
+
+    return wrapper
+
+
+_MODEL_STATS_COLUMNS = ("model_name", "requests", "total_tokens")
+_TOP_USERS_COLUMNS = ("username", "requests", "total_tokens")
+
+
+@_stats_cache
+def get_stats_for_date(date_str: str) -> dict[str, list]:
     """
     Собирает статистику использования моделей за определенную дату.
-    Возвращает список словарей, отсортированный по количеству запросов.
+    Возвращает колонки {'model_name': [...], 'requests': [...], 'total_tokens': [...]},
+    строки отсортированы по количеству запросов.
     """
+    _flush_usage()  # Статистика должна учитывать ещё не записанные строки
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row  # Позволяет обращаться к колонкам по имени
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT model_name, COUNT(*) as requests, SUM(total_tokens) as total_tokens
-                FROM usage
-                WHERE date(timestamp) = ?
+        with _connect() as conn:
+            cursor = conn.execute("""
+                SELECT model_name, SUM(requests) as requests, SUM(total_tokens) as total_tokens
+                FROM daily_user_stats
+                WHERE day = ?
                 GROUP BY model_name
                 ORDER BY requests DESC
             """, (date_str,))
-            stats = [dict(row) for row in cursor.fetchall()]
-            return stats
+            return _fetch_columns(cursor, _MODEL_STATS_COLUMNS)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении статистики из БД: {e}")
-        return []
+        return _empty_columns(_MODEL_STATS_COLUMNS)
 
-def get_top_users_for_date(date_str: str, limit: int = 20) -> list[dict]:
+@_stats_cache
+def get_top_users_for_date(date_str: str, limit: int = 20) -> dict[str, list]:
     """
-    Возвращает топ пользователей по количеству запросов за указанную дату.
-    Каждый элемент списка — словарь: {'username': ..., 'requests': ..., 'total_tokens': ...}
+    Возвращает топ пользователей по количеству запросов за указанную дату
+    в колоночном формате: {'username': [...], 'requests': [...], 'total_tokens': [...]}.
     """
+    _flush_usage()
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT username, COUNT(*) as requests, SUM(total_tokens) as total_tokens
-                FROM usage
-                WHERE date(timestamp) = ?
+        with _connect() as conn:
+            cursor = conn.execute("""
+                SELECT username, SUM(requests) as requests, SUM(total_tokens) as total_tokens
+                FROM daily_user_stats
+                WHERE day = ?
                 GROUP BY username
                 ORDER BY requests DESC, total_tokens DESC
                 LIMIT ?
             """, (date_str, limit))
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+            return _fetch_columns(cursor, _TOP_USERS_COLUMNS)
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении топа пользователей из БД: {e}")
-        return []
+        return _empty_columns(_TOP_USERS_COLUMNS)
 
+@_stats_cache
 def get_overall_user_stats_for_date(date_str: str) -> dict:
     """
     Собирает общую статистику по пользователям за указанную дату.
     Возвращает словарь с общим числом запросов, токенов и количеством уникальных пользователей.
     """
+    _flush_usage()
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            # Считаем общее количество запросов и токенов
-            cursor.execute("""
-                SELECT COUNT(*), SUM(total_tokens)
-                FROM usage
-                WHERE date(timestamp) = ?
-            """, (date_str,))
-            total_requests, total_tokens = cursor.fetchone()
-
-            # Считаем количество уникальных пользователей
+            # Считаем общее количество запросов, токенов и уникальных пользователей за один проход
             cursor.execute("""
-                SELECT COUNT(DISTINCT username)
-                FROM usage
-                WHERE date(timestamp) = ?
+                SELECT SUM(requests), SUM(total_tokens), COUNT(DISTINCT username)
+                FROM daily_user_stats
+                WHERE day = ?
             """, (date_str,))
-            unique_users_count = cursor.fetchone()[0]
+            total_requests, total_tokens, unique_users_count = cursor.fetchone()
 
             return {"total_requests": total_requests or 0, "total_tokens": total_tokens or 0, "unique_users_count": unique_users_count or 0}
     except sqlite3.Error as e:
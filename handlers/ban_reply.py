@@ -7,19 +7,29 @@ from telegram.ext import ContextTypes, ChatMemberHandler
 from config import ALLOWED_GROUP_IDS
 logger = logging.getLogger(__name__)
 
+# Фразы для реакции на бан (прописаны в коде)
+BAN_REACTION_PHRASES = (
+    "Пользователь {user_full_name} был забанен! Туда ему и дорога!",
+    "А вот и полетел в бан {user_full_name}! Кто-то расстроен?",
+    "{user_full_name} был забанен. Туда его нахер!",
+    "Был забанен {user_full_name}... Эх, жаль (нет)",
+    "{user_full_name} улетел в бан. Ибо нехрен выделываться!"
+)
+# Пауза перед сообщением о бане, в секундах
+BAN_REPLY_DELAY = 1
+
+
+async def _send_ban_reply(chat, message_to_send: str) -> None:
+    """Отправляет сообщение о бане после небольшой паузы."""
+    await asyncio.sleep(BAN_REPLY_DELAY)
+    await chat.send_message(message_to_send)
+
+
 async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Отслеживает изменения в статусе участников чата.
     Реагирует, когда пользователя блокируют (банят).
     """
-    # Список фраз для реакции на бан (теперь прописан в коде)
-    ban_reaction_phrases = [
-        "Пользователь {user_full_name} был забанен! Туда ему и дорога!",
-        "А вот и полетел в бан {user_full_name}! Кто-то расстроен?",
-        "{user_full_name} был забанен. Туда его нахер!",
-        "Был забанен {user_full_name}... Эх, жаль (нет)",
-        "{user_full_name} улетел в бан. Ибо нехрен выделываться!"
-    ]
     chat_id = update.effective_chat.id
 
     if ALLOWED_GROUP_IDS and int(chat_id) not in ALLOWED_GROUP_IDS:
@@ -39,17 +49,15 @@ async def track_chats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # Это гарантирует, что мы реагируем именно на событие бана, а не на другие изменения.
     if new_status == ChatMember.BANNED and old_status != ChatMember.BANNED:
         # Выбираем случайную фразу из списка
-        random_phrase = random.choice(ban_reaction_phrases)
+        random_phrase = random.choice(BAN_REACTION_PHRASES)
         # Форматируем сообщение, подставляя имя пользователя
         message_to_send = random_phrase.format(user_full_name=user.full_name)
 
         logger.info(f"Пользователь {user.full_name} ({user.id}) был забанен в чате {update.effective_chat.title} ({update.effective_chat.id}). Отправка сообщения через 1 секунду.")
-        
-        # Добавляем задержку в 1 секунду
-        await asyncio.sleep(1)
-        
-        # Отправляем сообщение в чат о бане
-        await update.effective_chat.send_message(message_to_send)
+
+        # Отправляем сообщение в чат о бане с задержкой в фоновой задаче,
+        # чтобы не держать обработчик (и очередь апдейтов) на время паузы
+        context.application.create_task(_send_ban_reply(update.effective_chat, message_to_send), update=update)
 
 
 # Создаем обработчик, который будет срабатывать на любые изменения в составе чата
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import time
 from telegram import Update
@@ -9,6 +10,26 @@ from .group_handler import REPLY_COOLDOWN
 
 logger = logging.getLogger(__name__)
 
+# Ключ в bot_data, под которым кэшируются названия групп {group_id: title}
+CHAT_TITLE_CACHE_KEY = "chat_title_cache"
+
+
+async def _get_chat_titles(context: ContextTypes.DEFAULT_TYPE) -> list[str]:
+    """
+    Возвращает названия групп из ALLOWED_GROUP_IDS в том же порядке.
+    Названия кэшируются в bot_data; отсутствующие в кэше запрашиваются у Telegram параллельно.
+    """
+    cache = context.application.bot_data.setdefault(CHAT_TITLE_CACHE_KEY, {})
+    missing = [group_id for group_id in ALLOWED_GROUP_IDS if group_id not in cache]
+    if missing:
+        chats = await asyncio.gather(*(context.bot.get_chat(group_id) for group_id in missing), return_exceptions=True)
+        for group_id, chat in zip(missing, chats):
+            # Неудачные запросы не кэшируем, чтобы повторить их при следующем вызове
+            if not isinstance(chat, BaseException):
+                cache[group_id] = chat.title
+    return [cache.get(group_id, f"Неизвестный чат ({group_id})") for group_id in ALLOWED_GROUP_IDS]
+
+
 async def cdcheck_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Показывает оставшееся время кулдауна для случайных ответов в группе.
@@ -25,20 +46,19 @@ async def cdcheck_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     response_lines = ["<b>Статус кулдаунов в чатах:</b>"]
 
-    for group_id in ALLOWED_GROUP_IDS:
-        try:
-            chat = await context.bot.get_chat(group_id)
-            chat_title = chat.title
-        except Exception:
-            chat_title = f"Неизвестный чат ({group_id})"
+    chat_titles = await _get_chat_titles(context)
+    # Текущее время и chat_data берём один раз для всех групп
+    now = time.time()
+    chat_data = context.application.chat_data
+
+    for group_id, chat_title in zip(ALLOWED_GROUP_IDS, chat_titles):
+        last_reply_time = (chat_data.get(group_id) or {}).get('last_random_reply_time', 0)
 
-        last_reply_time = context.application.chat_data.get(group_id, {}).get('last_random_reply_time', 0)
-        
         if last_reply_time == 0:
             response_lines.append(f"• <i>{chat_title}</i>: бот еще не отвечал, кулдаун не активен.")
             continue
 
-        time_since_last_reply = time.time() - last_reply_time
+        time_since_last_reply = now - last_reply_time
         remaining_cooldown = REPLY_COOLDOWN - time_since_last_reply
 
         if remaining_cooldown > 0:
@@ -1,18 +1,22 @@
+import asyncio
 import logging
 from telegram import Update
-import re
+from collections import Counter
 from telegram.ext import ContextTypes, MessageHandler, filters
-from telegram.constants import ChatAction
-from typing import Dict, Any
 
 # Импортируем утилиты и нужные компоненты из сервиса ИИ
-from services.ai_service import get_ai_response, retrieve_relevant_lore
-from handlers.utils import check_blacklist
+from services.ai_service import get_ai_response, AIReply
+from handlers.utils import check_blacklist, get_chat_history, get_chat_lock, await_with_typing
 from services.content_filter import filter_and_validate_response # Импортируем фильтр контента
 from database import create_or_update_user # Импортируем только нужную функцию
+from config import BOT_MAINTENANCE, ADMIN_ID
 
 logger = logging.getLogger(__name__)
 
+# Символы, которые нужно экранировать в Telegram MarkdownV2.
+# Таблица для str.translate строится один раз при импорте: замена идёт на стороне C без regex.
+_MD2_TABLE = str.maketrans({c: '\\' + c for c in r'\_*[]()~`>#+-=|{}.!'})
+
 def is_spam(text: str) -> bool:
     """
     Проверяет, является ли текст бессмысленным набором символов.
@@ -22,52 +26,55 @@ def is_spam(text: str) -> bool:
     if length < 150: # Короткие сообщения не проверяем, можно увеличить порог
         return False
 
+    # Один проход по тексту на стороне C: Counter считает, сколько раз встречается каждый символ.
+    # Дальше работаем уже с уникальными символами, а не со всем текстом.
+    char_counts = Counter(text)
     # Считаем количество букв и цифр
-    alnum_count = sum(1 for char in text if char.isalnum())
-    # Считаем количество уникальных символов
-    unique_chars = len(set(text))
+    alnum_count = sum(count for char, count in char_counts.items() if char.isalnum())
 
     # Если в длинном сообщении очень мало букв/цифр или очень мало уникальных символов, считаем это спамом.
-    return (alnum_count / length < 0.4) or (unique_chars < 15 and length > 200)
+    # Дешёвая проверка доли букв идёт первой; количество уникальных символов — это просто размер Counter,
+    # и смотрим его только для сообщений длиннее 200 символов.
+    if alnum_count / length < 0.4:
+        return True
+    return length > 200 and len(char_counts) < 15
 
 def escape_markdown_v2(text: str) -> str:
     """Экранирует специальные символы для Telegram MarkdownV2."""
-    # Список символов, которые нужно экранировать
-    escape_chars = r'\_*[]()~`>#+-=|{}.!'
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
-
-from config import BOT_MAINTENANCE, ADMIN_ID
+    return text.translate(_MD2_TABLE)
 
 @check_blacklist
 async def echo_logic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отвечает на текстовое сообщение с помощью ИИ."""
     user = update.effective_user
     message_text = update.message.text
-    logger.info(f"[РУ]{user.full_name} ({user.id}) написал: '{message_text}'")
 
     # Регистрируем или обновляем пользователя по каждому сообщению (легкая гарантия наличия записи)
     try:
         tg_username = f"@{user.username}" if user.username else None
-        create_or_update_user(user.full_name, tg_username, user.id)
+        # Запрос к SQLite выполняем в отдельном потоке, чтобы не блокировать event loop
+        await asyncio.to_thread(create_or_update_user, user.full_name, tg_username, user.id)
     except Exception:
         logger.exception("Не удалось создать/обновить запись пользователя в БД при обработке сообщения")
 
     # Проверяем, не находится ли бот в режиме обновления
     if BOT_MAINTENANCE and user.id != ADMIN_ID:
         response_text = "Бот на обновлении. Напиши попозже!"
-        logger.info(f"[РУ]Бот ответил {user.full_name} ({user.id}) (модель: system) (token usage: 0): '{response_text}'")
+        logger.info("[РУ]Бот ответил %s (%s) (модель: system) (token usage: 0): '%s'", user.full_name, user.id, response_text)
         await update.message.reply_text(response_text)
         return
 
     # Проверяем, подтвержден ли возраст, перед тем как отвечать
     if not context.user_data.get("age_verified"):
-        logger.warning(f"Пользователь {user.full_name} ({user.id}) попытался написать боту без подтверждения возраста.")
+        logger.warning("Пользователь %s (%s) попытался написать боту без подтверждения возраста.", user.full_name, user.id)
         await update.message.reply_text("Сначала подтверди свой возраст, нажав /start.")
         return
-        
+
+    logger.info("[РУ]%s (%s) написал: '%s'", user.full_name, user.id, message_text)
+
     # Проверяем сообщение на спам
     if is_spam(message_text):
-        logger.warning(f"Обнаружено спам-сообщение от {user.full_name} ({user.id}): '{message_text[:100]}...'")
+        logger.warning("Обнаружено спам-сообщение от %s (%s): '%s...'", user.full_name, user.id, message_text[:100])
         await update.message.reply_text("Кажется, это сообщение похоже на спам. Попробуй написать что-нибудь другое.")
         return
 
@@ -79,35 +86,29 @@ async def echo_logic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     # Проверяем сообщение на опасный контент (попытка провокации на токсичные темы)
     final_user_msg, was_msg_filtered = filter_and_validate_response(message_text)
     if was_msg_filtered:
-        logger.warning(f"Сообщение от {user.full_name} ({user.id}) содержало запрещённый контент. Отказываем и предлагаем другую тему.")
+        logger.warning("Сообщение от %s (%s) содержало запрещённый контент. Отказываем и предлагаем другую тему.", user.full_name, user.id)
         await update.message.reply_text("Это не мой базар. Поговорим о чём-нибудь другом.")
         return
 
-    # --- Этапы 1 и 2: Поиск релевантного лора и формирование промпта ---
-    # Получаем или создаем историю сообщений для этого пользователя
-    chat_history = context.user_data.get("chat_history", [])
+    # --- Этапы 1 и 2: История диалога (поиск лора и промпт формирует get_ai_response) ---
+    # Получаем или создаем историю сообщений для этого пользователя.
+    # Это deque на последние 6 сообщений, чтобы не превышать лимит контекста.
+    chat_history = get_chat_history(context.user_data, maxlen=6)
     # Добавляем текущее сообщение пользователя в историю для отправки в AI.
     # Команды уже отфильтрованы на уровне MessageHandler, так что здесь проверка не нужна.
     chat_history.append({"role": "user", "content": message_text})
 
-    # Находим релевантные абзацы
-    relevant_lore_chunk, lore_chunks_count = retrieve_relevant_lore(message_text)
-
     # --- Этап 3: Отправка запроса в ИИ ---
-    # Обрезаем историю до последних 6 сообщений, чтобы не превышать лимит контекста
-    # и сохраняем в user_data
-    chat_history = chat_history[-6:]
-    context.user_data["chat_history"] = chat_history
-
     try:
-        # Показываем статус набора текста
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-
-        # Получаем ответ от ИИ
-        response: Dict[str, Any] = await get_ai_response(
-            message_history=chat_history,
-            tg_id=user.id,
-            username=user.full_name or str(user.id)
+        # Получаем ответ от ИИ (статус набора текста показываем, только если ответ не пришел сразу)
+        response: AIReply = await await_with_typing(
+            context.bot,
+            update.effective_chat.id,
+            get_ai_response(
+                message_history=chat_history,
+                tg_id=user.id,
+                username=user.full_name or str(user.id)
+            ),
         )
         
         ai_message = response.get("message")
@@ -120,16 +121,15 @@ async def echo_logic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             final_response, was_filtered = filter_and_validate_response(ai_message)
             
             if was_filtered:
-                logger.warning(f"Ответ ИИ был отфильтрован из-за токсичности для пользователя {user.full_name} ({user.id})")
+                logger.warning("Ответ ИИ был отфильтрован из-за токсичности для пользователя %s (%s)", user.full_name, user.id)
             
             # Отправляем (возможно, отфильтрованный) ответ пользователю
             await update.message.reply_text(final_response)
-            logger.info(f"[РУ]Бот ответил {user.full_name} ({user.id}) (модель: {used_model}) (token usage: {total_tokens}) (filtered: {was_filtered}): '{final_response}'")
+            logger.info("[РУ]Бот ответил %s (%s) (модель: %s) (token usage: %s) (filtered: %s): '%s'", user.full_name, user.id, used_model, total_tokens, was_filtered, final_response)
             # Сохраняем ответ ассистента в историю только если это был успешный ответ от модели
             if used_model not in ['error', 'limit_exceeded', 'system']:
+                # chat_history уже лежит в user_data (get_chat_history), достаточно дописать в него
                 chat_history.append({"role": "assistant", "content": final_response})
-                # Сохраняем обновленную историю в user_data
-                context.user_data["chat_history"] = chat_history
 
                 # --- Поддержка бота: отправлять сообщение "Поддержи бота" каждые 20 нормальных ответов ---
                 # Используем отдельный ключ в user_data, чтобы считать только нормальные ответы (не ошибки и не system)
@@ -149,12 +149,15 @@ async def echo_logic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
             logger.warning("ИИ вернул пустой ответ.")
             await update.message.reply_text("Спроси лучш чё-нибудь другое.")
     except Exception as e:
-        logger.exception(f"Ошибка при запросе к ИИ: {e}")
+        logger.exception("Ошибка при запросе к ИИ: %s", e)
         await update.message.reply_text("У меня какие-то проблемы с ИИ сейчас — попробуй позже.")
 
 async def echo_handler_func(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Функция-обертка для регистрации в MessageHandler, предотвращает двойные вызовы."""
-    await echo_logic(update, context)
+    # Сообщения одного пользователя обрабатываем строго по очереди (общая история диалога),
+    # сообщения разных пользователей — параллельно
+    async with get_chat_lock(update.effective_chat.id):
+        await echo_logic(update, context)
 
 # Создаем фильтр для текстовых сообщений, которые не являются командами, в личных чатах.
 echo_filter = filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE
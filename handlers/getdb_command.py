@@ -1,10 +1,12 @@
+import asyncio
 import logging
 import os
+import tempfile
 from telegram import Update
 from telegram.ext import ContextTypes, CommandHandler, filters
 
 from config import ADMIN_ID
-from database import DB_NAME  # Импортируем путь к файлу БД
+from database import DB_NAME, backup_db  # Импортируем путь к файлу БД и функцию снимка
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +27,18 @@ async def getdb_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             return
 
         logger.info(f"Администратор {user_id} запросил файл базы данных. Отправка...")
-        await update.message.reply_document(document=open(DB_NAME, 'rb'), filename=os.path.basename(DB_NAME))
+        # Отправляем не сам файл (в режиме WAL часть данных может быть ещё в -wal),
+        # а согласованный снимок, сделанный через SQLite backup
+        fd, snapshot_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            if not await asyncio.to_thread(backup_db, snapshot_path):
+                await update.message.reply_text("Не удалось подготовить копию базы данных.")
+                return
+            with open(snapshot_path, 'rb') as snapshot:
+                await update.message.reply_document(document=snapshot, filename=os.path.basename(DB_NAME))
+        finally:
+            os.remove(snapshot_path)
     except Exception as e:
         logger.error(f"Ошибка при отправке файла базы данных: {e}")
         await update.message.reply_text("Произошла ошибка при отправке файла базы данных.")
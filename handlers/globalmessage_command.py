@@ -38,29 +38,28 @@ async def globalmessage_command(update: Update, context: ContextTypes.DEFAULT_TY
     command = "/globalmessage"
     message_to_send = update.message.text[len(command):].strip()
 
-    users = get_all_users()
+    users = await asyncio.to_thread(get_all_users)
 
-    if not users:
+    if not users['tg_id']:
         await update.message.reply_text("В базе данных нет пользователей для рассылки.")
         return
 
-    await update.message.reply_text(f"✅ Начинаю рассылку сообщения для {len(users)} пользователей. Это может занять некоторое время...")
+    await update.message.reply_text(f"✅ Начинаю рассылку сообщения для {len(users['tg_id'])} пользователей. Это может занять некоторое время...")
 
     success_count = 0
     fail_count = 0
     start_time = time.time()
 
-    for user_record in users:
-        tg_id = user_record.get('tg_id')
+    for tg_id, tg_username, nickname in zip(users['tg_id'], users['tg_username'], users['nickname']):
         if not tg_id:
             continue
 
         # Собираем информацию о пользователе для логов
         user_info_parts = [f"ID: {tg_id}"]
-        if user_record.get('tg_username'):
-            user_info_parts.append(str(user_record.get('tg_username')))
-        if user_record.get('nickname'):
-            user_info_parts.append(str(user_record.get('nickname')))
+        if tg_username:
+            user_info_parts.append(str(tg_username))
+        if nickname:
+            user_info_parts.append(str(nickname))
         user_info_str = ", ".join(user_info_parts)
 
         try:
@@ -3,11 +3,11 @@ import random
 import time
 from telegram import Update
 from telegram.ext import ContextTypes, MessageHandler, filters
-from telegram.constants import ChatAction
 
 from config import ALLOWED_GROUP_IDS, ADMIN_ID
 from services.ai_service import get_ai_response
 from services.content_filter import filter_and_validate_response
+from handlers.utils import get_chat_history, get_chat_lock, await_with_typing
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +16,14 @@ logger = logging.getLogger(__name__)
 REPLY_CHANCE = 3
 # Кулдаун в секундах (30 минут)
 REPLY_COOLDOWN = 30 * 60
-
-async def random_group_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# Вероятность ответа на одно сообщение
+_REPLY_PROB = 1.0 / REPLY_CHANCE
+# История группы: в ИИ уходят последние _CONTEXT_MESSAGES сообщений, а хранится на одно больше —
+# после ответа бота в истории остаются 4 отправленных сообщения и сам ответ
+_CONTEXT_MESSAGES = 4
+_HISTORY_MAXLEN = _CONTEXT_MESSAGES + 1
+
+async def random_group_reply_logic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Случайно отвечает на сообщения в разрешенных группах с кулдауном.
     """
@@ -28,51 +34,55 @@ async def random_group_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not user or user.is_bot or chat_id not in ALLOWED_GROUP_IDS:
         return
 
-    # Новая проверка: игнорируем сообщения с медиа (фото, видео, стикеры и т.д.)
-    if update.message and (update.message.photo or update.message.video or update.message.animation or update.message.document or update.message.audio or update.message.voice or update.message.sticker or update.message.video_note):
+    # Сообщения с медиа (фото, видео, стикеры и т.д.) отсекаются фильтром group_reply_filter
+
+    # Не отвечаем на слишком короткие сообщения — проверяем до кулдауна и броска шанса.
+    # Обычно текст не начинается и не заканчивается пробелом, и strip() (новая строка) не нужен.
+    message_text = update.message.text
+    if not message_text:
         return
+    if len(message_text) < 3 or message_text[0].isspace() or message_text[-1].isspace():
+        if len(message_text.strip()) < 3:
+            return
 
-    # 2. Проверяем кулдаун
+    # 2. Проверяем шанс ответа (до кулдауна: одно случайное число дешевле чтения часов,
+    # а в большинстве случаев на этом обработка и заканчивается)
+    if random.random() >= _REPLY_PROB:
+        return # В этот раз не отвечаем
+
+    # 3. Проверяем кулдаун
     current_time = time.time()
     last_reply_time = context.chat_data.get('last_random_reply_time', 0)
 
     time_since_last_reply = current_time - last_reply_time
     if time_since_last_reply < REPLY_COOLDOWN:
         return # Кулдаун еще не прошел
-    logger.info(f"[ГРУППА] Кулдаун закончен. Прошло {time_since_last_reply:.1f} сек.")
-
-    # 3. Проверяем шанс ответа
-    roll = random.randint(1, REPLY_CHANCE)
-    if roll != 1:
-        return # В этот раз не отвечаем
+    logger.info("[ГРУППА] Кулдаун закончен. Прошло %.1f сек.", time_since_last_reply)
 
     # --- Логика ответа ---
-    message_text = update.message.text
-    if not message_text or len(message_text.strip()) < 3:
-        return # Не отвечаем на слишком короткие сообщения или стикеры
-
     # 1. Бот берет сообщение в чате (название) от пользователя (никнейм, айди): (сообщение)
-    logger.info(f"[ГРУППА] Бот берет сообщение в чате {update.effective_chat.title} от пользователя {user.full_name} ({user.id}): '{message_text}'")
+    logger.info("[ГРУППА] Бот берет сообщение в чате %s от пользователя %s (%s): '%s'", update.effective_chat.title, user.full_name, user.id, message_text)
     
-    logger.info(f"[ГРУППА] Запрос отправлен в ИИ для чата {update.effective_chat.title}.")
+    logger.info("[ГРУППА] Запрос отправлен в ИИ для чата %s.", update.effective_chat.title)
 
     try:
-        # Получаем историю чата (последние 4 сообщения)
-        chat_history = context.chat_data.get("chat_history", [])
+        # Получаем историю чата (deque сам ограничивает её _HISTORY_MAXLEN сообщениями)
+        chat_history = get_chat_history(context.chat_data, maxlen=_HISTORY_MAXLEN)
         chat_history.append({"role": "user", "content": message_text})
-        chat_history = chat_history[-4:] # Ограничиваем историю
-
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
 
-        # Получаем ответ от ИИ
-        response = await get_ai_response(
-            message_history=chat_history,
-            tg_id=user.id,
-            username=user.full_name
+        # Получаем ответ от ИИ (статус набора текста — только если ответ не пришел сразу)
+        response = await await_with_typing(
+            context.bot,
+            chat_id,
+            get_ai_response(
+                message_history=list(chat_history)[-_CONTEXT_MESSAGES:],
+                tg_id=user.id,
+                username=user.full_name
+            ),
         )
 
         ai_message = response.get("message")
-        logger.info(f"[ГРУППА] Запрос отправлен и получен ответ от ИИ.")
+        logger.info("[ГРУППА] Запрос отправлен и получен ответ от ИИ.")
         if ai_message:
             # Фильтруем ответ на всякий случай
             final_response, was_filtered = filter_and_validate_response(ai_message, is_group_reply=True)
@@ -85,25 +95,42 @@ async def random_group_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     # Устанавливаем кулдаун ТОЛЬКО ПОСЛЕ успешной отправки
                     context.chat_data['last_random_reply_time'] = current_time
                     # 3. Бот ответил, старт кулдауна (время)
-                    logger.info(f"[ГРУППА] Бот ответил в чате {update.effective_chat.title}: '{final_response}'. Старт кулдауна на {REPLY_COOLDOWN} сек.")
+                    logger.info("[ГРУППА] Бот ответил в чате %s: '%s'. Старт кулдауна на %s сек.", update.effective_chat.title, final_response, REPLY_COOLDOWN)
 
-                    # Сохраняем историю
+                    # Сохраняем историю (deque уже лежит в chat_data, см. get_chat_history)
                     chat_history.append({"role": "assistant", "content": final_response})
-                    context.chat_data["chat_history"] = chat_history
                 else:
-                    logger.info(f"[ГРУППА] Ответ ИИ для чата {chat_id} был пустым после фильтрации. Ответ не отправлен, кулдаун не установлен.")
+                    logger.info("[ГРУППА] Ответ ИИ для чата %s был пустым после фильтрации. Ответ не отправлен, кулдаун не установлен.", chat_id)
             else:
-                logger.info(f"[ГРУППА] Ответ ИИ для чата {chat_id} был отфильтрован. Ответ не отправлен, кулдаун не установлен.")
+                logger.info("[ГРУППА] Ответ ИИ для чата %s был отфильтрован. Ответ не отправлен, кулдаун не установлен.", chat_id)
         else:
-            logger.warning(f"[ГРУППА] ИИ вернул пустой ответ для чата {chat_id}.")
+            logger.warning("[ГРУППА] ИИ вернул пустой ответ для чата %s.", chat_id)
 
     except Exception as e:
-        logger.exception(f"Ошибка при генерации случайного ответа в группе: {e}")
+        logger.exception("Ошибка при генерации случайного ответа в группе: %s", e)
         # В случае ошибки кулдаун не устанавливается, поэтому бот сможет
         # попробовать ответить на следующее подходящее сообщение.
 
 
-group_reply_handler = MessageHandler(
-    # Разрешаем работать и в обычных группах, и в супергруппах
-    filters.TEXT & ~filters.COMMAND & (filters.ChatType.GROUP | filters.ChatType.SUPERGROUP), random_group_reply
-)
\ No newline at end of file
+async def random_group_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обертка для MessageHandler: сообщения одной группы обрабатываются по очереди,
+    чтобы пока идёт запрос к ИИ, другое сообщение не прошло ту же проверку кулдауна.
+    """
+    async with get_chat_lock(update.effective_chat.id):
+        await random_group_reply_logic(update, context)
+
+
+# Медиа-фильтры: сообщения с фото, видео, стикерами и т.д. игнорируем ещё на уровне фильтра,
+# не запуская обработчик
+group_media_filter = (
+    filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.Document.ALL |
+    filters.AUDIO | filters.VOICE | filters.Sticker.ALL | filters.VIDEO_NOTE
+)
+# Разрешаем работать и в обычных группах, и в супергруппах
+group_reply_filter = (
+    filters.TEXT & ~filters.COMMAND & ~group_media_filter &
+    (filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
+)
+
+group_reply_handler = MessageHandler(group_reply_filter, random_group_reply)
\ No newline at end of file
@@ -9,18 +9,18 @@ logger = logging.getLogger(__name__)
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отвечает на медиафайлы сообщением о том, что бот их не распознает."""
     user = update.effective_user
-    logger.info(f"Пользователь {user.full_name} ({user.id}) отправил медиафайл, который не поддерживается.")
+    logger.info("Пользователь %s (%s) отправил медиафайл, который не поддерживается.", user.full_name, user.id)
 
     # Если бот на обслуживании и это не админ, отвечаем и выходим
     if BOT_MAINTENANCE and user.id != ADMIN_ID:
         response_text = "Бот на обновлении. Напиши попозже!"
-        logger.info(f"Отвечаем на медиафайл сообщением о тех. работах для {user.full_name} ({user.id}).")
+        logger.info("Отвечаем на медиафайл сообщением о тех. работах для %s (%s).", user.full_name, user.id)
         await update.message.reply_text(response_text)
         return
 
     # Проверяем, подтвержден ли возраст, так как это общая проверка для всех взаимодействий
     if not context.user_data.get("age_verified"):
-        logger.warning(f"Пользователь {user.full_name} ({user.id}) попытался отправить медиа без подтверждения возраста.")
+        logger.warning("Пользователь %s (%s) попытался отправить медиа без подтверждения возраста.", user.full_name, user.id)
         await update.message.reply_text("Сначала подтверди свой возраст, нажав /start.")
         return
 
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CommandHandler, filters
@@ -28,7 +29,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         user = update.effective_user
         tg_username = f"@{user.username}" if user.username else None
-        create_or_update_user(user.full_name, tg_username, user.id)
+        await asyncio.to_thread(create_or_update_user, user.full_name, tg_username, user.id)
     except Exception:
         logger.exception("Не удалось создать/обновить запись пользователя в БД при /start")
 
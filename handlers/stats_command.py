@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, filters
@@ -48,15 +49,15 @@ async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     logger.info(f"Администратор запросил статистику за {date_str}.")
 
-    stats = get_stats_for_date(date_str)
+    stats = await asyncio.to_thread(get_stats_for_date, date_str)
 
-    if not stats:
+    if not stats['model_name']:
         await query.edit_message_text(f"За {date_str} нет данных об использовании моделей.")
         return
 
     # Форматируем красивый отчет
-    total_requests = sum(s['requests'] for s in stats)
-    total_tokens = sum(s['total_tokens'] for s in stats)
+    total_requests = sum(stats['requests'])
+    total_tokens = sum(stats['total_tokens'])
     
     # Формируем заголовок с общей статистикой (с двойным переносом строки после каждой строки)
     header_lines = [
@@ -68,13 +69,11 @@ async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Формируем список моделей (без дополнительных пустых строк между ними)
     model_lines = []
-    for stat in stats:
-        model_name = stat['model_name']
-        spent_tokens = stat['total_tokens']
+    for model_name, requests, spent_tokens in zip(stats['model_name'], stats['requests'], stats['total_tokens']):
         # Получаем лимит для модели, если он не найден - ставим 0
         max_tokens = MODEL_TOKEN_LIMITS.get(model_name, 0)
         max_tokens_str = f"(макс: {max_tokens:,})".replace(',', ' ') if max_tokens > 0 else ""
-        model_lines.append(f"• `{model_name}`: *{stat['requests']}* запр., *{spent_tokens:,}* токенов {max_tokens_str}".replace(',', ' '))
+        model_lines.append(f"• `{model_name}`: *{requests}* запр., *{spent_tokens:,}* токенов {max_tokens_str}".replace(',', ' '))
 
     # Собираем финальное сообщение:
     # - Заголовок с двойными переносами между строками
@@ -1,4 +1,6 @@
+import asyncio
 import logging
+from itertools import chain
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, filters
 from datetime import date, timedelta
@@ -48,10 +50,13 @@ async def topusers_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     logger.info(f"Администратор запросил топ пользователей за {date_str}.")
 
     # Получаем данные для топа и для общей статистики
-    top_users = get_top_users_for_date(date_str, limit=20)
-    overall_stats = get_overall_user_stats_for_date(date_str)
+    # Запросы к БД выполняются в отдельных потоках, не блокируя event loop
+    top_users, overall_stats = await asyncio.gather(
+        asyncio.to_thread(get_top_users_for_date, date_str, limit=20),
+        asyncio.to_thread(get_overall_user_stats_for_date, date_str),
+    )
 
-    if not top_users:
+    if not top_users['username']:
         await query.edit_message_text(f"За {date_str} нет данных по пользователям.")
         return
 
@@ -68,22 +73,23 @@ async def topusers_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"📈 Среднее кол-во запросов на пользователя: {avg_requests:.1f}",
         f"🪙 Среднее кол-во токенов на пользователя: {avg_tokens:,.0f}".replace(',', ' '),
         "", # Пустая строка для отступа
-        f"(по количеству запросов, топ {len(top_users)})",
+        f"(по количеству запросов, топ {len(top_users['username'])})",
         "---"
     ]
 
-    user_lines = []
-    for idx, row in enumerate(top_users, start=1):
-        username = row.get('username') or 'unknown'
-        requests = row.get('requests', 0)
-        total_tokens = row.get('total_tokens') or 0
-        # форматируем: 1. @username (или id) — 123 запр., 4 567 ток.
-        user_lines.append(f"{idx}. {username} — {requests} запр., {total_tokens:,} ток.")
+    # форматируем: 1. @username (или id) — 123 запр., 4 567 ток.
+    rows = zip(top_users['username'], top_users['requests'], top_users['total_tokens'])
+    user_lines = (
+        f"{idx}. {username or 'unknown'} — {requests} запр., {total_tokens or 0:,} ток."
+        for idx, (username, requests, total_tokens) in enumerate(rows, start=1)
+    )
 
-    message = "\n\n".join(header_lines) + "\n\n" + "\n\n".join(user_lines)
+    # Заголовок и строки пользователей склеиваются за один проход
+    message = "\n\n".join(chain(header_lines, user_lines))
 
     await query.edit_message_text(message)
 
 
 topusers_handler = CommandHandler("topusers", topusers_command, filters=filters.ChatType.PRIVATE)
-topusers_callback_handler = CallbackQueryHandler(topusers_callback, pattern="^topusers_")
+# block=False: ответ на кнопку читает БД, обработка остальных апдейтов не ждёт его завершения
+topusers_callback_handler = CallbackQueryHandler(topusers_callback, pattern="^topusers_", block=False)
@@ -1,11 +1,65 @@
+import asyncio
 import logging
+import weakref
+from collections import deque
 from functools import wraps
 from telegram import Update
+from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
 from config import BLACKLIST
 
 logger = logging.getLogger(__name__)
 
+def get_chat_history(data: dict, maxlen: int) -> deque:
+    """
+    Возвращает историю диалога из user_data/chat_data как deque(maxlen=maxlen).
+    Старые записи (обычные списки) один раз конвертируются и сохраняются обратно,
+    дальше append сам отбрасывает самые старые сообщения без копирования списка.
+    """
+    history = data.get("chat_history")
+    if not isinstance(history, deque) or history.maxlen != maxlen:
+        history = deque(history or (), maxlen=maxlen)
+        data["chat_history"] = history
+    return history
+
+
+# Блокировки по чатам. Бот обрабатывает апдейты параллельно (concurrent_updates в bot.py),
+# а эти блокировки сохраняют порядок обработки сообщений внутри одного чата.
+# WeakValueDictionary сам удаляет блокировку, когда её никто не держит и не ждёт.
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def get_chat_lock(chat_id: int) -> asyncio.Lock:
+    """Возвращает asyncio.Lock для указанного чата."""
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _chat_locks[chat_id] = lock
+    return lock
+
+
+# Через сколько секунд ожидания ответа ИИ показывать статус "печатает".
+# Быстрые ответы (например, из кэша) приходят раньше, и лишний запрос к Bot API не тратится.
+_TYPING_DELAY = 0.2
+
+
+async def await_with_typing(bot, chat_id: int, coro):
+    """
+    Выполняет coro и отправляет ChatAction.TYPING, только если ответ не готов за _TYPING_DELAY.
+    Возвращает результат coro.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=_TYPING_DELAY)
+        if not done:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        return await task
+    finally:
+        # Если отправка статуса упала или обработчик отменили — не оставляем запрос висеть
+        if not task.done():
+            task.cancel()
+
+
 def check_blacklist(func):
     """
     Декоратор для проверки, не находится ли пользователь в черном списке.
@@ -15,7 +69,7 @@ def check_blacklist(func):
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user = update.effective_user
         if user.id in BLACKLIST:
-            logger.warning(f"Заблокированный пользователь пытается использовать бота: {user.id} (@{user.username})")
+            logger.warning("Заблокированный пользователь пытается использовать бота: %s (@%s)", user.id, user.username)
             await update.message.reply_text(
                 "Извините, но вам был ограничен доступ к функциям этого бота. "
                 "Если вы считаете, что это ошибка, свяжитесь с Вороном - https://vk.com/voronthestalker"
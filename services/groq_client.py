@@ -2,15 +2,75 @@
 Модуль для работы с Groq API и LLM моделями.
 Содержит инициализацию клиента, список моделей, работу с запросами и обработку ответов.
 """
+import asyncio
+import hashlib
+import json
 import logging
+import random
 import re
-from openai import AsyncOpenAI, RateLimitError
+import time
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+from typing import Optional, TypedDict
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
 
 from config import GROQ_API_KEY, SYSTEM_PROMPT
 from database import log_usage_to_db
+from .lore_search import retrieve_relevant_lore
 
 logger = logging.getLogger(__name__)
 
+
+class AIReply(TypedDict, total=False):
+    """Ответ get_ai_response. Для ошибок ('error', 'limit_exceeded') ключа 'tokens' нет."""
+    message: str
+    model: str
+    tokens: int
+
+
+# Шаблон блока с лором, который дописывается к системному промпту
+_LORE_TEMPLATE = "\n\nВОСПОМИНАНИЕ ИЗ ТВОЕЙ ИСТОРИИ ДЛЯ КОНТЕКСТА:\n{}"
+
+# --- Кэш ответов ИИ ---
+# Одинаковая история диалога (повторные вопросы после /reset, типовые фразы в группах)
+# даёт ответ из кэша без запроса к API. Ключ — хэш истории сообщений.
+# Старые записи вытесняются по LRU, а ответы старше _AI_CACHE_TTL запрашиваются заново.
+_AI_CACHE_MAX_SIZE = 1024
+_AI_CACHE_TTL = 24 * 60 * 60
+_ai_cache: "OrderedDict[bytes, tuple[float, AIReply]]" = OrderedDict()
+# Ответ из кэша всё равно записывается в usage (для /stats, /topusers и total_requests),
+# но с нулевым расходом токенов и пометкой _CACHED_MODEL_SUFFIX у модели
+_CACHED_USAGE = SimpleNamespace(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+_CACHED_MODEL_SUFFIX = " (cache)"
+
+
+def _history_cache_key(message_history) -> bytes:
+    """Хэш содержимого истории сообщений для ключа кэша."""
+    payload = json.dumps(list(message_history), ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+
+def _get_cached_response(key: bytes) -> Optional[AIReply]:
+    """Возвращает ответ из кэша, если он есть и не устарел."""
+    cached = _ai_cache.get(key)
+    if cached is None:
+        return None
+    created_at, response = cached
+    if time.monotonic() - created_at > _AI_CACHE_TTL:
+        del _ai_cache[key]
+        return None
+    _ai_cache.move_to_end(key)
+    return response
+
+
+def _put_cached_response(key: bytes, response: AIReply) -> None:
+    """Сохраняет успешный ответ в кэш, вытесняя самый давно использованный."""
+    _ai_cache[key] = (time.monotonic(), response)
+    _ai_cache.move_to_end(key)
+    if len(_ai_cache) > _AI_CACHE_MAX_SIZE:
+        _ai_cache.popitem(last=False)
+
+
 # Инициализируем асинхронный клиент, настроенный на Groq
 client = AsyncOpenAI(
     api_key=GROQ_API_KEY,
@@ -48,6 +108,109 @@ MODEL_TOKEN_LIMITS = {
 }
 
 
+# --- Учёт лимитов моделей ---
+# Модель, ответившая 429, пропускается до истечения Retry-After (если сервер его не прислал —
+# _RATE_LIMIT_COOLDOWN секунд, и не дольше _MAX_RATE_LIMIT_COOLDOWN). Иначе каждое новое
+# сообщение заново упиралось бы в уже исчерпанные модели в начале списка.
+_RATE_LIMIT_COOLDOWN = 60.0
+_MAX_RATE_LIMIT_COOLDOWN = 60 * 60.0
+_model_blocked_until: dict = {}  # модель -> time.monotonic(), до которого её не трогаем
+
+
+def _rate_limit_cooldown(error: RateLimitError) -> float:
+    """Сколько секунд не обращаться к модели после 429."""
+    try:
+        retry_after = float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return _RATE_LIMIT_COOLDOWN
+    return min(max(retry_after, 0.0), _MAX_RATE_LIMIT_COOLDOWN)
+
+
+# Короткие реплики ("привет", "как дела") не тратят самые маленькие суточные лимиты:
+# модели с лимитом меньше _SHORT_QUERY_MIN_BUDGET для них ставятся в конец списка
+_SHORT_QUERY_WORDS = 10
+_SHORT_QUERY_MIN_BUDGET = 10_000
+
+
+def models_for(user_query: str) -> list:
+    """Порядок моделей для запроса: MODELS_TO_TRY без моделей, которые сейчас упёрлись в лимит."""
+    now = time.monotonic()
+    models = [model for model in MODELS_TO_TRY if _model_blocked_until.get(model, 0.0) <= now]
+    if len(user_query.split()) < _SHORT_QUERY_WORDS:
+        # sorted стабилен: внутри каждой группы исходный порядок сохраняется
+        models.sort(key=lambda model: MODEL_TOKEN_LIMITS.get(model, 0) < _SHORT_QUERY_MIN_BUDGET)
+    return models
+
+
+# Через сколько секунд без ответа параллельно подключать следующую модель из списка
+# и сколько запросов к разным моделям может идти одновременно
+_HEDGE_DELAY = 5.0
+_RACE_WIDTH = 2
+
+
+# Не больше стольких одновременных запросов к одной модели: при всплеске сообщений
+# лишние ждут своей очереди, а не упираются в 429 и не тратят попытки на ретраи
+_MODEL_MAX_CONCURRENCY = 4
+MODEL_SEMAPHORES = {model: asyncio.Semaphore(_MODEL_MAX_CONCURRENCY) for model in MODELS_TO_TRY}
+
+
+# Временные сбои (таймаут, обрыв соединения, 5xx) повторяем с экспоненциальной задержкой
+# и случайным разбросом. Клиент создан с max_retries=0, так что повторы делаются только здесь.
+# 429 сюда не относится: при лимите сразу переключаемся на следующую модель.
+_TRANSIENT_ERRORS = (APIConnectionError, InternalServerError)  # APITimeoutError — подкласс APIConnectionError
+_TRANSIENT_ATTEMPTS = 3
+_BACKOFF_BASE = 0.5
+_BACKOFF_MAX = 8.0
+
+
+async def _request_completion(model: str, messages: list):
+    """Один запрос к модели. Лимит токенов ставим для всех моделей, кроме qwen/qwen3-32b."""
+    max_tokens_for_model = None if model == "qwen/qwen3-32b" else 150
+    for attempt in range(_TRANSIENT_ATTEMPTS):
+        try:
+            async with MODEL_SEMAPHORES[model]:
+                return await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=0.5,
+                    max_tokens=max_tokens_for_model,
+                )
+        except _TRANSIENT_ERRORS as e:
+            if attempt == _TRANSIENT_ATTEMPTS - 1:
+                raise
+            delay = random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** attempt))
+            logger.warning(f"Временная ошибка Groq API с моделью {model} ({e}), повтор через {delay:.1f} сек.")
+            await asyncio.sleep(delay)
+
+
+# --- Ограничение размера промпта ---
+# История уже ограничена по числу сообщений (deque в handlers.utils), но длинные сообщения
+# всё равно могут раздуть запрос до 413. Грубая оценка: ~4 символа на токен.
+_PROMPT_TOKEN_BUDGET = 6000
+_CHARS_PER_TOKEN = 4
+
+
+def _trim_history(message_history, system_prompt: str) -> list:
+    """
+    Отбрасывает самые старые сообщения, пока оценка токенов (промпт + история) не уложится
+    в _PROMPT_TOKEN_BUDGET. Последнее сообщение пользователя остаётся всегда.
+    """
+    history = list(message_history)
+    approx_tokens = (len(system_prompt) + sum(len(m['content']) for m in history)) // _CHARS_PER_TOKEN
+    start = 0
+    while approx_tokens > _PROMPT_TOKEN_BUDGET and start < len(history) - 1:
+        approx_tokens -= len(history[start]['content']) // _CHARS_PER_TOKEN
+        start += 1
+    # Пары вопрос-ответ не разрываем: история не должна начинаться с ответа ассистента
+    if start and history[start]['role'] == 'assistant' and start < len(history) - 1:
+        start += 1
+    return history[start:]
+
+
+# Блоки рассуждений qwen (<think>...</think>) вырезаются из ответа
+_THINK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+
+
 def _strip_think_tags(text: str, model_name: str) -> str:
     """
     Обрабатывает теги <think> в ответе ИИ.
@@ -57,7 +220,7 @@ def _strip_think_tags(text: str, model_name: str) -> str:
     if "<think>" in text:
         if model_name == "qwen/qwen3-32b":
             # Для qwen просто удаляем блок
-            processed_text = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL)
+            processed_text = _THINK_RE.sub("", text)
             return processed_text.strip()
         else:
             # Для остальных моделей возвращаем ошибку
@@ -65,7 +228,7 @@ def _strip_think_tags(text: str, model_name: str) -> str:
     return text.strip()
 
 
-async def get_ai_response(message_history: list, tg_id: int, username: str) -> dict:
+async def get_ai_response(message_history: list, tg_id: int, username: str) -> AIReply:
     """
     Отправляет историю сообщений в Groq. При достижении лимита одной модели,
     автоматически переключается на следующую из списка.
@@ -75,60 +238,106 @@ async def get_ai_response(message_history: list, tg_id: int, username: str) -> d
     - 'model': название использованной модели
     - 'tokens': количество использованных токенов (если успешно)
     """
-    from .lore_search import retrieve_relevant_lore
-    
-    # 1. Извлекаем релевантную информацию из лора на основе последнего сообщения пользователя
+    # 0. Та же история уже встречалась — отвечаем из кэша без поиска по лору и запроса к API
     user_query = message_history[-1]['content']
-    relevant_lore_chunk, lore_chunks_count = retrieve_relevant_lore(user_query)
+    cache_key = _history_cache_key(message_history)
+    cached_response = _get_cached_response(cache_key)
+    if cached_response is not None:
+        logger.info(f"Ответ ИИ взят из кэша для {username}.")
+        # Запрос учитываем в статистике, но токены на этот ответ не тратились
+        log_usage_to_db(tg_id, username, user_query, _CACHED_USAGE, cached_response["message"], 0, cached_response["model"] + _CACHED_MODEL_SUFFIX)
+        return {**cached_response, "tokens": 0}
 
-    # 2. Формируем динамический системный промпт
-    dynamic_system_prompt = SYSTEM_PROMPT
+    # 1. Извлекаем релевантную информацию из лора на основе последнего сообщения пользователя
+    # Поиск по лору — чистый CPU (токенизация, стемминг, подсчёт релевантности),
+    # поэтому выполняем его в отдельном потоке, чтобы не блокировать event loop
+    relevant_lore_chunk, lore_chunks_count = await asyncio.to_thread(retrieve_relevant_lore, user_query)
 
+    # 2. Формируем динамический системный промпт
     # Добавляем найденный чанк из эпизода, если он есть
-    if relevant_lore_chunk:
-        dynamic_system_prompt += f"\n\nВОСПОМИНАНИЕ ИЗ ТВОЕЙ ИСТОРИИ ДЛЯ КОНТЕКСТА:\n{relevant_lore_chunk}"
+    dynamic_system_prompt = SYSTEM_PROMPT + (_LORE_TEMPLATE.format(relevant_lore_chunk) if relevant_lore_chunk else "")
 
-    messages_with_prompt = [{"role": "system", "content": dynamic_system_prompt}] + message_history
+    trimmed_history = _trim_history(message_history, dynamic_system_prompt)
+    if len(trimmed_history) < len(message_history):
+        logger.info(f"История для {username} сокращена с {len(message_history)} до {len(trimmed_history)} сообщений (лимит промпта).")
+    messages_with_prompt = [{"role": "system", "content": dynamic_system_prompt}, *trimmed_history]
 
-    for model in MODELS_TO_TRY:
-        try:
-            logger.info(f"Отправка запроса в Groq (модель: {model}) с последним сообщением: '{user_query}'")
-            
-            # Устанавливаем лимит токенов для всех моделей, кроме qwen/qwen3-32b
-            max_tokens_for_model = None if model == "qwen/qwen3-32b" else 150
-
-            response = await client.chat.completions.create(
-                model=model,
-                messages=messages_with_prompt,
-                temperature=0.5,
-                max_tokens=max_tokens_for_model,
+    # Модели пробуются по очереди, но если текущая не ответила за _HEDGE_DELAY секунд,
+    # параллельно запускается следующая (не больше _RACE_WIDTH одновременно).
+    # Берём первый успешный ответ, остальные запросы отменяем.
+    pending_models = deque(models_for(user_query))
+    running: dict = {}  # asyncio.Task -> модель
+
+    def start_next_model() -> None:
+        model = pending_models.popleft()
+        logger.info(f"Отправка запроса в Groq (модель: {model}) с последним сообщением: '{user_query}'")
+        running[asyncio.create_task(_request_completion(model, messages_with_prompt))] = model
+
+    def cancel_running() -> None:
+        for task in running:
+            task.cancel()
+        running.clear()
+
+    try:
+        while running or pending_models:
+            if not running:
+                start_next_model()
+            can_hedge = bool(pending_models) and len(running) < _RACE_WIDTH
+            done, _ = await asyncio.wait(
+                running,
+                timeout=_HEDGE_DELAY if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
             )
-            raw_message = response.choices[0].message.content
-            ai_message = _strip_think_tags(raw_message, model)
-            # Temporary log: raw AI message before processing
-            # logger.info(f"Raw AI Message: {raw_message}")
-
-            # Логируем использование токенов в консоль и в БД
-            logger.info(f"Token Usage: {username} - {response.usage.total_tokens} (Total)")
-            log_usage_to_db(tg_id, username, user_query, response.usage, ai_message, lore_chunks_count, model)
-            return {
-                "message": ai_message,
-                "model": model,
-                "tokens": response.usage.total_tokens
-            }
-        except RateLimitError:
-            logger.warning(f"Достигнут лимит для модели ({model}). Переключаюсь на следующую.")
-            continue  # Переходим к следующей модели в цикле
-        except Exception as e:
-            # Специальная обработка ошибки "Request Entity Too Large"
-            if "Error code: 413" in str(e) and "Request Entity Too Large" in str(e):
-                logger.warning(f"Ошибка 413 (Request Too Large) с моделью {model}. Попытка отправить запрос без лора.")
-                return await get_ai_response_without_lore(message_history, model, tg_id, username)
-
-            logger.error(f"Критическая ошибка при обращении к Groq API с моделью {model}: {e}")
-            return {"message": "Хм, чёт у меня какие-то неполадки... Напиши потом.", "model": "error"}
-
-    # Этот код выполнится, только если все модели из списка исчерпали лимиты
+            if not done:
+                # Текущая модель отвечает слишком долго — подключаем следующую параллельно
+                logger.info(f"Нет ответа от {', '.join(running.values())} за {_HEDGE_DELAY} сек., подключаю следующую модель.")
+                start_next_model()
+                continue
+
+            for task in done:
+                model = running.pop(task)
+                try:
+                    response = task.result()
+                    raw_message = response.choices[0].message.content
+                    ai_message = _strip_think_tags(raw_message, model)
+                    # Temporary log: raw AI message before processing
+                    # logger.info(f"Raw AI Message: {raw_message}")
+                except RateLimitError as e:
+                    cooldown = _rate_limit_cooldown(e)
+                    _model_blocked_until[model] = time.monotonic() + cooldown
+                    logger.warning(f"Достигнут лимит для модели ({model}), пропускаю её {cooldown:.0f} сек. Переключаюсь на следующую.")
+                    continue  # Переходим к следующей модели
+                except Exception as e:
+                    if running:
+                        # Параллельно ещё ждём ответ другой модели — ошибку этой просто логируем
+                        logger.error(f"Ошибка при обращении к Groq API с моделью {model}: {e}")
+                        continue
+                    # Специальная обработка ошибки "Request Entity Too Large"
+                    if "Error code: 413" in str(e) and "Request Entity Too Large" in str(e):
+                        logger.warning(f"Ошибка 413 (Request Too Large) с моделью {model}. Попытка отправить запрос без лора.")
+                        return await get_ai_response_without_lore(message_history, model, tg_id, username, user_query)
+
+                    logger.error(f"Критическая ошибка при обращении к Groq API с моделью {model}: {e}")
+                    return {"message": "Хм, чёт у меня какие-то неполадки... Напиши потом.", "model": "error"}
+
+                # Успешный ответ — остальные запросы больше не нужны
+                cancel_running()
+
+                # Логируем использование токенов в консоль и в БД
+                logger.info(f"Token Usage: {username} - {response.usage.total_tokens} (Total)")
+                log_usage_to_db(tg_id, username, user_query, response.usage, ai_message, lore_chunks_count, model)
+                result = {
+                    "message": ai_message,
+                    "model": model,
+                    "tokens": response.usage.total_tokens
+                }
+                _put_cached_response(cache_key, result)
+                return result
+    finally:
+        # Например, если сам обработчик отменили — не оставляем запросы висеть
+        cancel_running()
+
+    # Этот код выполнится, только если все модели из списка исчерпали лимиты (сейчас или недавно)
     logger.error("Все доступные модели исчерпали свои лимиты.")
     return {
         "message": "Мля, я заманался с тобой болтать. Приходи в другой раз. (токены закончились, напиши через несколько часов)",
@@ -136,26 +345,18 @@ async def get_ai_response(message_history: list, tg_id: int, username: str) -> d
     }
     
 
-async def get_ai_response_without_lore(message_history: list, model: str, tg_id: int, username: str) -> dict:
+async def get_ai_response_without_lore(message_history: list, model: str, tg_id: int, username: str, user_query: str) -> AIReply:
     """Запасной метод для отправки запроса без RAG-контекста."""
     try:
         logger.info(f"Повторная отправка запроса в Groq (модель: {model}) без лора.")
         base_prompt = SYSTEM_PROMPT
-        messages_with_prompt = [{"role": "system", "content": base_prompt}] + message_history
-
-        # Устанавливаем лимит токенов для всех моделей, кроме qwen/qwen3-32b
-        max_tokens_for_model = None if model == "qwen/qwen3-32b" else 150
+        messages_with_prompt = [{"role": "system", "content": base_prompt}, *message_history]
 
-        response = await client.chat.completions.create(
-            model=model,
-            messages=messages_with_prompt,
-            temperature=0.5,
-            max_tokens=max_tokens_for_model,
-        )
+        response = await _request_completion(model, messages_with_prompt)
         raw_message = response.choices[0].message.content
         ai_message = _strip_think_tags(raw_message, model)
         logger.info(f"Token Usage (without lore): {username} - {response.usage.total_tokens} (Total)")
-        log_usage_to_db(tg_id, username, message_history[-1]['content'], response.usage, ai_message, lore_chunks_count=0, model_name=model)
+        log_usage_to_db(tg_id, username, user_query, response.usage, ai_message, lore_chunks_count=0, model_name=model)
         return {
             "message": ai_message,
             "model": model,
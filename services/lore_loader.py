@@ -1,20 +1,30 @@
 """
-Модуль для загрузки и управления лором.
-Содержит всё, что связано с персонажами, локациями, аномалиями, мутантами и текстами эпизодов.
+Модуль с общими утилитами лора: токенизация, стемминг, лемматизация
+и ручные списки персонажей, локаций, аномалий, мутантов и группировок.
+Сами файлы лора разбирает lore_structure.
 """
 import logging
 import re
+import sys
+from functools import lru_cache
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
 # --- Стеммер для более гибкого поиска ---
+# PyStemmer — обёртка над libstemmer на C (тот же алгоритм Snowball, со своим кэшем),
+# заметно быстрее NLTK. Если его нет, используем стеммер из NLTK.
 try:
-    from nltk.stem.snowball import SnowballStemmer
-    STEMMER = SnowballStemmer("russian")
+    import Stemmer
+    STEMMER = Stemmer.Stemmer("russian")
+    STEMMER.maxCacheSize = 20_000
 except ImportError:
-    logger.warning("Библиотека NLTK не найдена. Поиск будет работать без стемминга. Для установки: pip install nltk")
-    STEMMER = None
+    try:
+        from nltk.stem.snowball import SnowballStemmer
+        STEMMER = SnowballStemmer("russian")
+    except ImportError:
+        logger.warning("Библиотеки PyStemmer и NLTK не найдены. Поиск будет работать без стемминга. Для установки: pip install PyStemmer")
+        STEMMER = None
 
 # Попробуем подключить морфологический анализатор для нормализации (лемматизации)
 try:
@@ -26,25 +36,48 @@ except Exception:
     logger.debug("pymorphy2 не найден — лемматизация отключена. Установите pymorphy2 для улучшения распознавания имён.")
 
 # Список стоп-слов для исключения из поиска
-STOP_WORDS = set([
+STOP_WORDS = frozenset([
     "а", "в", "и", "к", "на", "о", "об", "от", "по", "под", "при", "с", "со", "у", "же", "ли", "бы"
 ])
 
+# Всё, что не буква/цифра и не пробельный символ (то же, что `not (c.isalnum() or c.isspace())`;
+# \w дополнительно пропускает "_", поэтому он указан отдельно)
+_NON_WORD_RE = re.compile(r"[^\w\s]|_")
+
+
+@lru_cache(maxsize=50_000)
+def _stem(word: str) -> str:
+    """Основа слова через NLTK. Кэшируется: одни и те же слова повторяются по всему лору и в запросах."""
+    return STEMMER.stem(word)
+
 
 def get_stemmed_words(text: str) -> set:
     """Вспомогательная функция для получения набора основ слов из текста."""
-    clean_text = ''.join(c for c in text.lower() if c.isalnum() or c.isspace())
+    clean_text = _NON_WORD_RE.sub("", text.lower())
+    words = [word for word in clean_text.split() if word not in STOP_WORDS]
     if not STEMMER:
-        return {word for word in clean_text.split() if word not in STOP_WORDS}
-    return {STEMMER.stem(word) for word in clean_text.split() if word not in STOP_WORDS}
+        return set(words)
+    if hasattr(STEMMER, "stemWords"):
+        # PyStemmer: весь список за один вызов C-кода
+        return set(STEMMER.stemWords(words))
+    return {_stem(word) for word in words}
 
 
 def get_tokens(text: str) -> list:
     """Возвращает список токенов (слова) из текста в нижнем регистре, без стоп-слов."""
-    clean_text = ''.join((c.lower() if (c.isalnum() or c.isspace()) else ' ') for c in text)
+    clean_text = _NON_WORD_RE.sub(" ", text).lower()
     return [w for w in clean_text.split() if w and w not in STOP_WORDS]
 
 
+@lru_cache(maxsize=200_000)
+def _lemma(token: str) -> str:
+    """Нормальная форма слова через pymorphy2. Кэшируется: разбор — самая дорогая часть загрузки лора."""
+    try:
+        return MORPH.parse(token)[0].normal_form
+    except Exception:
+        return token
+
+
 def get_lemmas(text: str) -> set:
     """Возвращает множество лемм (нормализованных форм) слов в тексте.
     Если pymorphy2 недоступен — возвращаем просто токены без стемминга.
@@ -52,13 +85,16 @@ def get_lemmas(text: str) -> set:
     tokens = get_tokens(text)
     if not MORPH:
         return set(tokens)
-    lemmas = set()
-    for t in tokens:
-        try:
-            lemmas.add(MORPH.parse(t)[0].normal_form)
-        except Exception:
-            lemmas.add(t)
-    return lemmas
+    return {_lemma(t) for t in tokens}
+
+
+def intern_words(words) -> set:
+    """
+    Интернирует слова при загрузке лора: одинаковые токены/стемы/леммы из разных чанков
+    становятся одним объектом строки (меньше памяти, сравнение по ссылке).
+    Для слов из запросов не вызывается — интернированные строки живут до конца процесса.
+    """
+    return {sys.intern(word) for word in words}
 
 
 # --- РУЧНОЙ СПИСОК ЛОКАЦИЙ ---
@@ -196,63 +232,7 @@ for exact in list(EXACT_IMPORTANT_KEYWORDS):
 # Нормализованные леммы для точных ключевых слов
 EXACT_IMPORTANT_LEMMAS = set()
 for exact in EXACT_IMPORTANT_KEYWORDS:
-    if MORPH:
-        try:
-            EXACT_IMPORTANT_LEMMAS.add(MORPH.parse(exact)[0].normal_form)
-        except Exception:
-            EXACT_IMPORTANT_LEMMAS.add(exact)
-    else:
-        EXACT_IMPORTANT_LEMMAS.add(exact)
+    EXACT_IMPORTANT_LEMMAS.add(_lemma(exact) if MORPH else exact)
 
 # --- Предварительная обработка локаций ---
 STEMMED_LOCATIONS = {loc: get_stemmed_words(loc) for loc in KNOWN_LOCATIONS}
-
-# --- Система управления лором ---
-EPISODE_CHUNKS = []
-GENERAL_CHUNKS = []
-
-try:
-    lore_dir = Path(__file__).resolve().parent.parent / "lore"
-    episodes_dir = lore_dir / "episodes"
-    
-    # 1. Загружаем и разделяем на чанки файлы эпизодов
-    if episodes_dir.is_dir():
-        for file_path in episodes_dir.glob("*.txt"):
-            relative_path_key = str(file_path.relative_to(lore_dir))
-            try:
-                content = file_path.read_text(encoding="utf-8")
-                
-                first_line, rest_of_content = content.split('\n', 1)
-                file_locations = set()
-                match = re.search(r'Локация\s*[:—-]?\s*(.+)', first_line, re.IGNORECASE)
-                if match:
-                    location_names_str = match.group(1).replace('.', '').strip()
-                    found_locations = {name.strip().lower() for name in location_names_str.split(',') if name.strip()}
-                    file_locations.update(found_locations)
-                    logger.info(f"Для файла '{file_path.name}' определены локации: {list(file_locations)}")
-
-                for chunk in content.split('\n\n'):
-                    if chunk.strip():
-                        chunk_text = chunk.strip()
-                        EPISODE_CHUNKS.append({'source': relative_path_key, 'content': chunk_text, 'locations': file_locations, 'lemmas': get_lemmas(chunk_text)})
-            except Exception as e:
-                logger.error(f"Не удалось прочитать файл эпизода '{file_path}': {e}")
-
-    # 2. Загружаем и разделяем на чанки общие файлы лора (в корне папки lore)
-    for file_path in lore_dir.glob("*.txt"):
-        relative_path_key = str(file_path.relative_to(lore_dir))
-        try:
-            content = file_path.read_text(encoding="utf-8")
-            for chunk in content.split('\n\n'):
-                if chunk.strip():
-                    chunk_text = chunk.strip()
-                    GENERAL_CHUNKS.append({'source': relative_path_key, 'content': chunk_text, 'locations': set(), 'lemmas': get_lemmas(chunk_text)})
-        except Exception as e:
-            logger.error(f"Не удалось прочитать общий файл лора '{file_path}': {e}")
-
-    logger.info(f"Загружено {len(EPISODE_CHUNKS)} чанков из эпизодов и {len(GENERAL_CHUNKS)} общих чанков лора.")
-
-except FileNotFoundError:
-    logger.error("Папка 'lore' или её компоненты не найдены! Убедитесь, что существует структура 'lore/episodes/'")
-except Exception as e:
-    logger.exception(f"Ошибка при чтении файлов лора: {e}")
@@ -2,13 +2,17 @@
 Продвинутый модуль поиска лора с многоуровневой релевантностью и контекстным анализом.
 Заменяет lore_retrieval.py с более интеллектуальным подходом.
 """
+import heapq
 import logging
 import re
+import threading
+from bisect import bisect_right
+from functools import lru_cache
 from typing import List, Dict, Tuple, Optional
 
 from .lore_structure import get_lore_structure, Character, Location, Anomaly, Mutant
 from .lore_loader import (
-    get_stemmed_words, get_lemmas, get_tokens, STEMMER, STOP_WORDS
+    get_stemmed_words, get_lemmas, get_tokens, STEMMER, STOP_WORDS, intern_words
 )
 
 logger = logging.getLogger(__name__)
@@ -55,6 +59,58 @@ class LoreContextEngine:
     def __init__(self):
         self.lore = get_lore_structure()
         self.query_history: List[str] = []
+        self._build_general_index()
+
+        # Описания персонажей в нижнем регистре для поиска упоминаний (лор не меняется после загрузки)
+        self._char_descriptions_lower: Dict[str, str] = {
+            key: character.description.lower() for key, character in self.lore.characters.items()
+        }
+
+    def _build_general_index(self):
+        """
+        Индекс для общего поиска по описаниям (_retrieve_general_context).
+        Описания всех сущностей склеиваются в один текст в нижнем регистре, а смещения начала
+        каждого описания запоминаются. Тогда сущности, в которых встречается слово запроса,
+        находятся через str.find по общему тексту, и оцениваются только они, а не весь лор.
+        """
+        entries = []
+        for character in self.lore.characters.values():
+            entries.append((f"**Персонаж: {character.name}**\n{character.description}", character.description))
+        for location in self.lore.locations.values():
+            entries.append((f"**Локация: {location.name}**\n{location.description}", location.description))
+        for anomaly in self.lore.anomalies.values():
+            entries.append((f"**Аномалия: {anomaly.name}**\n{anomaly.description}", anomaly.description))
+        for mutant in self.lore.mutants.values():
+            entries.append((f"**Мутант: {mutant.name}**\n{mutant.description}", mutant.description))
+
+        # (текст для контекста, описание в нижнем регистре, множество токенов описания)
+        self._general_entries = [
+            (context_text, description.lower(), frozenset(intern_words(get_tokens(description))))
+            for context_text, description in entries
+        ]
+        # \0 не встречается в токенах запроса, поэтому совпадение не может перейти через границу описаний
+        self._general_offsets = []
+        offset = 0
+        for _, text_lower, _ in self._general_entries:
+            self._general_offsets.append(offset)
+            offset += len(text_lower) + 1
+        self._general_corpus = "\0".join(text_lower for _, text_lower, _ in self._general_entries)
+
+    def _find_general_candidates(self, query_tokens: List[str]) -> List[int]:
+        """Номера описаний, в которые хотя бы одно слово запроса входит подстрокой (в исходном порядке)."""
+        corpus = self._general_corpus
+        offsets = self._general_offsets
+        candidates = set()
+        for query_word in set(query_tokens):
+            pos = corpus.find(query_word)
+            while pos != -1:
+                entry_id = bisect_right(offsets, pos) - 1
+                candidates.add(entry_id)
+                if entry_id + 1 >= len(offsets):
+                    break
+                # Это описание уже найдено — продолжаем со следующего
+                pos = corpus.find(query_word, offsets[entry_id + 1])
+        return sorted(candidates)
     
     def retrieve_context(self, query: str, max_tokens: int = 4000) -> Tuple[str, Dict]:
         """
@@ -414,45 +470,22 @@ class LoreContextEngine:
         query_lower = query.lower()
         query_tokens = get_tokens(query)
         
-        results = []
         context_parts = []
         relevance_scores = []
         
-        # 1. Поиск в описаниях персонажей
-        for char_key, character in self.lore.characters.items():
-            if self._contains_query_words(character.description, query_tokens):
-                relevance = self._calculate_relevance(character.description, query_tokens)
-                context_parts.append(f"**Персонаж: {character.name}**\n{character.description}")
-                relevance_scores.append(relevance)
-        
-        # 2. Поиск в локациях
-        for loc_key, location in self.lore.locations.items():
-            if self._contains_query_words(location.description, query_tokens):
-                relevance = self._calculate_relevance(location.description, query_tokens)
-                context_parts.append(f"**Локация: {location.name}**\n{location.description}")
-                relevance_scores.append(relevance)
-        
-        # 3. Поиск в аномалиях
-        for anom_key, anomaly in self.lore.anomalies.items():
-            if self._contains_query_words(anomaly.description, query_tokens):
-                relevance = self._calculate_relevance(anomaly.description, query_tokens)
-                context_parts.append(f"**Аномалия: {anomaly.name}**\n{anomaly.description}")
-                relevance_scores.append(relevance)
-        
-        # 4. Поиск в мутантах
-        for mut_key, mutant in self.lore.mutants.items():
-            if self._contains_query_words(mutant.description, query_tokens):
-                relevance = self._calculate_relevance(mutant.description, query_tokens)
-                context_parts.append(f"**Мутант: {mutant.name}**\n{mutant.description}")
-                relevance_scores.append(relevance)
+        # Поиск в описаниях персонажей, локаций, аномалий и мутантов через индекс
+        for entry_id in self._find_general_candidates(query_tokens):
+            context_text, text_lower, text_tokens = self._general_entries[entry_id]
+            context_parts.append(context_text)
+            relevance_scores.append(self._score_tokens(text_lower, text_tokens, query_tokens))
         
         if not context_parts:
             logger.warning(f"Не найден контекст для запроса: {query}")
             return "", 0.0
         
-        # Сортируем по релевантности
-        sorted_parts = [x for _, x in sorted(zip(relevance_scores, context_parts), reverse=True)]
-        context = "\n\n---\n\n".join(sorted_parts[:5])  # Берём топ 5
+        # Берём топ 5 по релевантности (nlargest = sorted(reverse=True)[:5] без сортировки всех совпадений)
+        top_parts = [x for _, x in heapq.nlargest(5, zip(relevance_scores, context_parts))]
+        context = "\n\n---\n\n".join(top_parts)
         
         avg_relevance = sum(relevance_scores) / len(relevance_scores) if relevance_scores else 0.0
         return context, min(avg_relevance, 100.0)
@@ -499,24 +532,12 @@ class LoreContextEngine:
 
         return '\n\n---\n\n'.join(context_parts), min(relevance, 100.0)
     
-    def _contains_query_words(self, text: str, query_tokens: List[str]) -> bool:
-        """Проверяет, содержит ли текст слова из запроса"""
-        text_lower = text.lower()
-        text_tokens = get_tokens(text)
-        
-        for query_word in query_tokens:
-            if query_word in text_tokens:
-                return True
-            if query_word in text_lower:
-                return True
-        
-        return False
-    
-    def _calculate_relevance(self, text: str, query_tokens: List[str]) -> float:
-        """Рассчитывает релевантность текста по количеству совпадений ключевых слов"""
-        text_lower = text.lower()
-        text_tokens = get_tokens(text)
-        
+    @staticmethod
+    def _score_tokens(text_lower: str, text_tokens, query_tokens: List[str]) -> float:
+        """
+        Рассчитывает релевантность текста по количеству совпадений ключевых слов
+        (текст в нижнем регистре и его токены подготовлены заранее, см. _build_general_index)
+        """
         matches = 0
         for query_word in query_tokens:
             if query_word in text_tokens:
@@ -544,9 +565,10 @@ class LoreContextEngine:
         # Ищем упоминания этого персонажа в описаниях других персонажей
         mentions = []
         char_name_lower = character.name.lower()
+        char_descriptions_lower = self._char_descriptions_lower
         for other_key, other_char in self.lore.characters.items():
             if other_key != char_name_lower:
-                if char_name_lower in other_char.description.lower():
+                if char_name_lower in char_descriptions_lower[other_key]:
                     mentions.append(f"Упомянут(а) в информации о {other_char.name}")
         
         if mentions and len(mentions) <= 3:  # Не добавляем слишком много
@@ -559,9 +581,10 @@ class LoreContextEngine:
         found_chars = []
         loc_name_lower = location.name.lower()
         
+        char_descriptions_lower = self._char_descriptions_lower
         for char_key, character in self.lore.characters.items():
             # Проверяем упоминание локации в описании персонажа
-            if loc_name_lower in character.description.lower():
+            if loc_name_lower in char_descriptions_lower[char_key]:
                 found_chars.append(f"- {character.name}: {character.description[:100]}...")
         
         return found_chars[:5]  # Максимум 5 персонажей
@@ -569,23 +592,40 @@ class LoreContextEngine:
 
 # Глобальный экземпляр движка
 _ENGINE = None
+# Поиск вызывается из пула потоков (asyncio.to_thread), и первые запросы могут прийти одновременно —
+# блокировка не даёт загрузить лор и построить индексы несколько раз
+_ENGINE_LOCK = threading.Lock()
 
 
 def get_lore_engine() -> LoreContextEngine:
     """Возвращает глобальный экземпляр движка поиска лора"""
     global _ENGINE
     if _ENGINE is None:
-        _ENGINE = LoreContextEngine()
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                _ENGINE = LoreContextEngine()
     return _ENGINE
 
 
-def retrieve_relevant_lore(user_query: str) -> Tuple[str, int]:
+def preload_lore_engine() -> None:
     """
-    Совместимая функция с текущим интерфейсом.
-    Возвращает кортеж (контекст, количество найденных сущностей).
+    Загружает лор и строит индексы в фоновом потоке при старте бота,
+    чтобы первый пользователь не ждал этого в своём запросе.
+    Запросы, пришедшие раньше окончания загрузки, дождутся её на _ENGINE_LOCK.
     """
+    threading.Thread(target=get_lore_engine, name="lore-preload", daemon=True).start()
+
+
+# Сколько последних запросов к лору держать в кэше. Лор загружается один раз при старте
+# и не меняется, поэтому результат зависит только от текста запроса.
+_LORE_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=_LORE_CACHE_SIZE)
+def _retrieve_relevant_lore_cached(query_lower: str) -> Tuple[str, int]:
+    """Поиск контекста по запросу в нижнем регистре (результат кэшируется)."""
     engine = get_lore_engine()
-    context, metadata = engine.retrieve_context(user_query)
+    context, metadata = engine.retrieve_context(query_lower)
     
     entity_count = len(metadata.get('found_entities', []))
     
@@ -594,3 +634,14 @@ def retrieve_relevant_lore(user_query: str) -> Tuple[str, int]:
         logger.info(f"\n{'='*80}\nВЫБРАННЫЙ КОНТЕКСТ ИЗ ЛОРА:\n{'='*80}\n{context}\n{'='*80}\n")
     
     return context, entity_count
+
+
+def retrieve_relevant_lore(user_query: str) -> Tuple[str, int]:
+    """
+    Совместимая функция с текущим интерфейсом.
+    Возвращает кортеж (контекст, количество найденных сущностей).
+    Поиск регистронезависимый и не зависит от пробелов по краям, поэтому ключ кэша —
+    обрезанный запрос в нижнем регистре (без сортировки слов: многословные алиасы
+    ищутся подстрокой в исходном порядке).
+    """
+    return _retrieve_relevant_lore_cached(user_query.strip().lower())
@@ -2,8 +2,12 @@
 Модуль для структурированной работы с лором. 14/11/2025
 Парсит файлы лора в структурированный формат и обеспечивает интеллектуальный поиск.
 """
+import heapq
 import logging
+import pickle
 import re
+import sys
+import threading
 from pathlib import Path
 from dataclasses import dataclass, field
 from typing import Optional, Set, List, Dict, Tuple
@@ -13,11 +17,44 @@ logger = logging.getLogger(__name__)
 # Импортируем утилиты из lore_loader
 from .lore_loader import (
     STEMMER, MORPH, get_stemmed_words, get_lemmas, get_tokens,
-    STOP_WORDS
+    STOP_WORDS, intern_words
 )
+from database import DATA_DIR
 
+LORE_DIR = Path(__file__).resolve().parent.parent / "Lore"
 
-@dataclass
+# Разобранный лор сохраняется между перезапусками (лемматизация эпизодов через pymorphy2 — долгая).
+# Кэш лежит рядом с БД (на Railway это подключенный том) и пересобирается,
+# если изменился любой файл лора, формат кэша или набор стеммера/лемматизатора.
+LORE_CACHE_PATH = Path(DATA_DIR) / "lore_cache.pkl"
+_LORE_CACHE_VERSION = 4
+
+# --- Регулярки разбора файлов лора (компилируются один раз) ---
+# "Отношение Пончика - XXX" в описании персонажа; группа 1 — само отношение
+_RELATIONSHIP_RE = re.compile(
+    r'(?:отношение|Отношение)\s+(?:пончика|Пончика)\s*(?::|-|—)\s*([^,.\n]+)',
+    re.IGNORECASE
+)
+# Отделяет название от описания: "Название — описание"
+_DASH_SPLIT_RE = re.compile(r'[-–—:]')
+# Секция без одного из этих разделителей в первой строке не считается сущностью
+# (короткое тире "–" здесь, в отличие от _DASH_SPLIT_RE, исторически не учитывается)
+_NAME_SEPS = frozenset('—-:')
+# Разделители алиасов в названии: "Локация, локация / другое имя (сокращение)"
+_ALIAS_SPLIT_RE = re.compile(r'[,/;|()]')
+# Блок "{ ... }" в файле персонажей: от открывающей скобки до ближайшей закрывающей
+_BLOCK_RE = re.compile(r'\{([^}]*)\}')
+
+# Вес точного совпадения имени и вес одного совпавшего стема для каждой категории в search_by_keywords
+_SEARCH_WEIGHTS = {
+    'characters': (50, 10),
+    'locations': (40, 8),
+    'anomalies': (35, 7),
+    'mutants': (35, 7),
+}
+
+
+@dataclass(slots=True)
 class Character:
     """Структура для персонажа из лора"""
     name: str
@@ -46,7 +83,7 @@ class Character:
         return "\n".join(parts)
 
 
-@dataclass
+@dataclass(slots=True)
 class Location:
     """Структура для локации"""
     name: str
@@ -57,7 +94,7 @@ class Location:
     episodes: List[Dict] = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class Anomaly:
     """Структура для аномалии"""
     name: str
@@ -69,7 +106,7 @@ class Anomaly:
 
 
 
-@dataclass
+@dataclass(slots=True)
 class Mutant:
     """Структура для мутанта"""
     name: str
@@ -79,7 +116,7 @@ class Mutant:
     behavior: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class Term:
     """Структура для термина/определения"""
     name: str
@@ -88,7 +125,7 @@ class Term:
     context: str = ""
 
 
-@dataclass
+@dataclass(slots=True)
 class Faction:
     """Структура для группировки/фракции"""
     name: str
@@ -99,6 +136,16 @@ class Faction:
     relations_with_ponchik: str = ""
 
 
+@dataclass(slots=True)
+class _SearchIndex:
+    """Обратный индекс сущностей для search_by_keywords: слово/стем -> номера сущностей."""
+    entities: List[Tuple[str, object]] = field(default_factory=list)  # (категория, сущность)
+    name_weights: List[int] = field(default_factory=list)
+    stem_weights: List[int] = field(default_factory=list)
+    name_postings: Dict[str, List[int]] = field(default_factory=dict)
+    stem_postings: Dict[str, List[int]] = field(default_factory=dict)
+
+
 class LoreStructure:
     """Основной класс для управления структурированным лором"""
     
@@ -116,6 +163,9 @@ class LoreStructure:
         self.loc_aliases_index: Dict[str, str] = {}
         self.term_aliases_index: Dict[str, str] = {}
         self.faction_aliases_index: Dict[str, str] = {}
+
+        # Обратный индекс для search_by_keywords (строится один раз при первом поиске)
+        self._search_index: Optional[_SearchIndex] = None
         
         self._load_lore()
     
@@ -123,7 +173,7 @@ class LoreStructure:
         """Загружает и парсит все файлы лора"""
         logger.info("Начало загрузки структурированного лора...")
         
-        lore_dir = Path(__file__).resolve().parent.parent / "Lore"
+        lore_dir = LORE_DIR
         
         if not lore_dir.exists():
             logger.error(f"Папка лора не найдена: {lore_dir}")
@@ -137,17 +187,17 @@ class LoreStructure:
         # 2. Загружаем локации
         locations_file = lore_dir / "Локации.txt"
         if locations_file.exists():
-            self._load_locations(locations_file)
+            self._load_simple_entities(locations_file, Location, self.locations, "локаций", self.loc_aliases_index)
         
         # 3. Загружаем аномалии
         anomalies_file = lore_dir / "Аномалии.txt"
         if anomalies_file.exists():
-            self._load_anomalies(anomalies_file)
+            self._load_simple_entities(anomalies_file, Anomaly, self.anomalies, "аномалий")
         
         # 4. Загружаем мутантов
         mutants_file = lore_dir / "Мутанты.txt"
         if mutants_file.exists():
-            self._load_mutants(mutants_file)
+            self._load_simple_entities(mutants_file, Mutant, self.mutants, "мутантов")
         
         # 5. Загружаем термины
         terms_file = lore_dir / "Термины.txt"
@@ -172,32 +222,19 @@ class LoreStructure:
     
     def _load_characters(self, filepath: Path):
         """Парсит файл персонажей"""
+        # Блоки "Заголовок: { ... }" — собираются за один проход по файлу и используются обеими фазами
+        blocks: List[Tuple[str, str]] = []
         try:
             content = filepath.read_text(encoding='utf-8')
             
-            # Фаза 1: парсим основные персонажи из секций "Группа: { ... }"
-            current_pos = 0
+            for match in _BLOCK_RE.finditer(content):
+                brace_pos = match.start()
+                # Заголовок — текст от начала строки до открывающей скобки
+                line_start = content.rfind('\n', 0, brace_pos) + 1
+                blocks.append((content[line_start:brace_pos].strip(), match.group(1).strip()))
             
-            while current_pos < len(content):
-                brace_pos = content.find('{', current_pos)
-                if brace_pos == -1:
-                    break
-                
-                close_brace = content.find('}', brace_pos)
-                if close_brace == -1:
-                    break
-                
-                # Достаём заголовок блока
-                before_brace = content[:brace_pos]
-                last_newline = before_brace.rfind('\n')
-                if last_newline == -1:
-                    last_newline = 0
-                else:
-                    last_newline += 1
-                
-                block_header = before_brace[last_newline:brace_pos].strip()
-                block_content = content[brace_pos + 1:close_brace].strip()
-                
+            # Фаза 1: парсим основные персонажи из секций "Группа: { ... }"
+            for block_header, block_content in blocks:
                 logger.debug(f"Обработка блока: {block_header}")
                 
                 # Разделяем контент на записи о персонажах по пустым строкам
@@ -217,8 +254,6 @@ class LoreStructure:
                 # Обработаем оставшихся в буфере
                 if current_char_lines:
                     self._parse_character_entry('\n'.join(current_char_lines))
-                
-                current_pos = close_brace + 1
             
             logger.info(f"Загружено {len(self.characters)} персонажей")
         
@@ -227,27 +262,7 @@ class LoreStructure:
         
         # Фаза 2: обработка специальных секций типа "Персонажи, с которыми Пончик не знаком: { A, B, C }"
         try:
-            current_pos = 0
-            while current_pos < len(content):
-                brace_pos = content.find('{', current_pos)
-                if brace_pos == -1:
-                    break
-                
-                close_brace = content.find('}', brace_pos)
-                if close_brace == -1:
-                    break
-                
-                # Достаём заголовок
-                before_brace = content[:brace_pos]
-                last_newline = before_brace.rfind('\n')
-                if last_newline == -1:
-                    last_newline = 0
-                else:
-                    last_newline += 1
-                
-                block_header = before_brace[last_newline:brace_pos].strip()
-                block_content = content[brace_pos + 1:close_brace].strip()
-                
+            for block_header, block_content in blocks:
                 # Определяем отношение по заголовку
                 relation = None
                 if 'не знаком' in block_header.lower():
@@ -260,7 +275,6 @@ class LoreStructure:
                     relation = 'нейтральное'
                 
                 if not relation:
-                    current_pos = close_brace + 1
                     continue
                 
                 logger.debug(f"Спецсекция '{block_header}' с отношением '{relation}'")
@@ -289,8 +303,6 @@ class LoreStructure:
                                 logger.debug(f"Установлено отношение '{relation}' для {char.name}")
                         else:
                             logger.debug(f"Не найден персонаж: '{raw_name}'")
-                
-                current_pos = close_brace + 1
         
         except Exception as e:
             logger.debug(f"Ошибка при обработке спецсекций: {e}", exc_info=True)
@@ -312,22 +324,16 @@ class LoreStructure:
         
         canonical_name = raw_names[0].title()
         names_lower = [n.lower() for n in raw_names]
-        aliases = set(names_lower[1:])
+        aliases = intern_words(names_lower[1:])
         
         description = description_full.strip().rstrip('.')
         
         # Ищем отношение Пончика
         relationship = ""
-        rel_match = re.search(
-            r'(?:отношение|Отношение)\s+(?:пончика|Пончика)\s*(?::|-|—)\s*([^,.\n]+)',
-            description, re.IGNORECASE
-        )
+        rel_match = _RELATIONSHIP_RE.search(description)
         if rel_match:
             relationship = rel_match.group(1).strip().rstrip('.,')
-            description = re.sub(
-                r'(?:отношение|Отношение)\s+(?:пончика|Пончика)\s*(?::|-|—)\s*[^,.\n]+',
-                '', description, flags=re.IGNORECASE
-            ).strip()
+            description = _RELATIONSHIP_RE.sub('', description).strip()
         
         character = Character(
             name=canonical_name,
@@ -336,7 +342,7 @@ class LoreStructure:
             relationship=relationship
         )
         
-        canonical_key = canonical_name.lower()
+        canonical_key = sys.intern(canonical_name.lower())
         self.characters[canonical_key] = character
         
         self.char_aliases_index[canonical_key] = canonical_key
@@ -345,161 +351,75 @@ class LoreStructure:
         
         logger.debug(f"Загружен персонаж: {canonical_name}, rel='{relationship}'")
     
-    def _load_locations(self, filepath: Path):
-        """Парсит файл локаций"""
-        try:
-            content = filepath.read_text(encoding='utf-8')
-            
-            # Разделяем по двойным пустым строкам
-            sections = content.split('\n\n')
-            
-            for section in sections:
-                if not section.strip():
-                    continue
-                
-                lines = section.strip().split('\n')
-                if not lines or not lines[0]:
-                    continue
-                
-                # Парсим название локации
-                first_line = lines[0]
-                if not any(c in first_line for c in ['—', '-', ':']):
-                    # Если нет разделителя, пропускаем
-                    continue
-                    
-                # Обработка алиасов в виде "Локация, локация, другое имя"
-                name_part = re.split(r'[-–—:]', first_line)[0].strip()
-                
-                loc_parts = [n.strip().lower() for n in re.split(r'[,/;|()]', name_part) if n.strip()]
-                if not loc_parts:
-                    continue
-                
-                canonical_name = loc_parts[0].title()
-                aliases = set(loc_parts[1:])
-                
-                # Описание - остальной текст
-                description = ':'.join(first_line.split(':', 1)[1:]).strip() if ':' in first_line else ''
-                rest_text = '\n'.join(lines[1:]).strip()
-                if rest_text:
-                    description = (description + ' ' + rest_text).strip()
-                
-                location = Location(
-                    name=canonical_name,
-                    aliases=aliases,
-                    description=description
-                )
-                
-                canonical_key = canonical_name.lower()
-                self.locations[canonical_key] = location
-                
-                # Индексируем все варианты имена
-                self.loc_aliases_index[canonical_key] = canonical_key
-                for alias in aliases:
-                    self.loc_aliases_index[alias] = canonical_key
-                
-                logger.debug(f"Загружена локация: {canonical_name} (алиасы: {aliases})")
-            
-            logger.info(f"Загружено {len(self.locations)} локаций")
-            logger.debug(f"Индекс локаций: {list(self.loc_aliases_index.items())}")
+    @staticmethod
+    def _parse_named_section(section: str) -> Optional[Tuple[str, Set[str], str]]:
+        """
+        Разбирает секцию вида "Название, алиас / алиас — описание\nдоп. текст".
+        Возвращает (каноническое имя, алиасы, описание) или None, если секция не подходит.
+        """
+        # Первая строка — название и описание, остальное — дополнительный текст
+        first_line, _, rest_text = section.strip().partition('\n')
+        if not first_line:
+            return None
         
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке локаций: {e}", exc_info=True)
-    
-    def _load_anomalies(self, filepath: Path):
-        """Парсит файл аномалий"""
-        try:
-            content = filepath.read_text(encoding='utf-8')
-            
-            # Разделяем по двойным пустым строкам
-            sections = content.split('\n\n')
-            
-            for section in sections:
-                if not section.strip():
-                    continue
-                
-                lines = section.strip().split('\n')
-                if not lines or not lines[0]:
-                    continue
-                
-                first_line = lines[0]
-                if not any(c in first_line for c in ['—', '-', ':']):
-                    continue
-                    
-                name_part = re.split(r'[-–—:]', first_line)[0].strip()
-                
-                names = [n.strip().lower() for n in re.split(r'[,/;|()]', name_part) if n.strip()]
-                if not names:
-                    continue
-                
-                canonical_name = names[0].title()
-                aliases = set(names[1:])
-                
-                description = ':'.join(first_line.split(':', 1)[1:]).strip() if ':' in first_line else ''
-                rest_text = '\n'.join(lines[1:]).strip()
-                if rest_text:
-                    description = (description + ' ' + rest_text).strip()
-                
-                anomaly = Anomaly(
-                    name=canonical_name,
-                    aliases=aliases,
-                    description=description
-                )
-                
-                canonical_key = canonical_name.lower()
-                self.anomalies[canonical_key] = anomaly
-            
-            logger.info(f"Загружено {len(self.anomalies)} аномалий")
+        if _NAME_SEPS.isdisjoint(first_line):
+            # Если нет разделителя, пропускаем
+            return None
         
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке аномалий: {e}", exc_info=True)
+        # Обработка алиасов в виде "Локация, локация, другое имя"
+        name_part = _DASH_SPLIT_RE.split(first_line)[0].strip()
+        
+        names = [n.strip().lower() for n in _ALIAS_SPLIT_RE.split(name_part) if n.strip()]
+        if not names:
+            return None
+        
+        # Описание - остальной текст
+        description = ':'.join(first_line.split(':', 1)[1:]).strip() if ':' in first_line else ''
+        rest_text = rest_text.strip()
+        if rest_text:
+            description = (description + ' ' + rest_text).strip()
+        
+        return names[0].title(), intern_words(names[1:]), description
     
-    def _load_mutants(self, filepath: Path):
-        """Парсит файл мутантов"""
+    def _load_simple_entities(self, filepath: Path, cls, registry: Dict, kind: str,
+                              aliases_index: Optional[Dict[str, str]] = None):
+        """
+        Общий парсер файлов локаций, аномалий и мутантов: секции через пустую строку,
+        каждая разбирается _parse_named_section и сохраняется как cls(name, aliases, description).
+        kind — название сущностей во множественном числе для логов ("локаций").
+        """
         try:
             content = filepath.read_text(encoding='utf-8')
             
             # Разделяем по двойным пустым строкам
-            sections = content.split('\n\n')
-            
-            for section in sections:
+            for section in content.split('\n\n'):
                 if not section.strip():
                     continue
                 
-                lines = section.strip().split('\n')
-                if not lines or not lines[0]:
-                    continue
-                
-                first_line = lines[0]
-                if not any(c in first_line for c in ['—', '-', ':']):
-                    continue
-                    
-                name_part = re.split(r'[-–—:]', first_line)[0].strip()
-                
-                names = [n.strip().lower() for n in re.split(r'[,/;|()]', name_part) if n.strip()]
-                if not names:
+                parsed = self._parse_named_section(section)
+                if not parsed:
                     continue
+                canonical_name, aliases, description = parsed
                 
-                canonical_name = names[0].title()
-                aliases = set(names[1:])
-                
-                description = ':'.join(first_line.split(':', 1)[1:]).strip() if ':' in first_line else ''
-                rest_text = '\n'.join(lines[1:]).strip()
-                if rest_text:
-                    description = (description + ' ' + rest_text).strip()
-                
-                mutant = Mutant(
+                canonical_key = sys.intern(canonical_name.lower())
+                registry[canonical_key] = cls(
                     name=canonical_name,
                     aliases=aliases,
                     description=description
                 )
                 
-                canonical_key = canonical_name.lower()
-                self.mutants[canonical_key] = mutant
+                # Индексируем все варианты имени
+                if aliases_index is not None:
+                    aliases_index[canonical_key] = canonical_key
+                    for alias in aliases:
+                        aliases_index[alias] = canonical_key
+                
+                logger.debug(f"Загружено: {canonical_name} (алиасы: {aliases})")
             
-            logger.info(f"Загружено {len(self.mutants)} мутантов")
+            logger.info(f"Загружено {len(registry)} {kind}")
         
         except Exception as e:
-            logger.error(f"Ошибка при загрузке мутантов: {e}", exc_info=True)
+            logger.error(f"Ошибка при загрузке {kind}: {e}", exc_info=True)
     
     def _load_terms(self, filepath: Path):
         """Загружает термины и определения из файла"""
@@ -513,12 +433,11 @@ class LoreStructure:
                 if not section.strip():
                     continue
                 
-                lines = section.strip().split('\n')
-                if not lines or not lines[0]:
+                first_line, _, rest_text = section.strip().partition('\n')
+                if not first_line:
                     continue
                 
                 # Парсим "Термин: определение"
-                first_line = lines[0]
                 if ':' not in first_line:
                     continue
                 
@@ -527,9 +446,9 @@ class LoreStructure:
                 definition = definition.strip()
                 
                 # Остальные строки - дополнительный контекст
-                context = '\n'.join(lines[1:]).strip() if len(lines) > 1 else ""
+                context = rest_text.strip()
                 
-                canonical_key = term_name.lower()
+                canonical_key = sys.intern(term_name.lower())
                 term = Term(
                     name=term_name,
                     definition=definition,
@@ -556,12 +475,11 @@ class LoreStructure:
                 if not section.strip():
                     continue
                 
-                lines = section.strip().split('\n')
-                if not lines or not lines[0]:
+                first_line, _, rest_text = section.strip().partition('\n')
+                if not first_line:
                     continue
                 
                 # Парсим "Группировка: описание"
-                first_line = lines[0]
                 if ':' not in first_line:
                     continue
                 
@@ -570,9 +488,9 @@ class LoreStructure:
                 description = description.strip()
                 
                 # Остальные строки - цели, члены и т.д.
-                additional_info = '\n'.join(lines[1:]).strip() if len(lines) > 1 else ""
+                additional_info = rest_text.strip()
                 
-                canonical_key = faction_name.lower()
+                canonical_key = sys.intern(faction_name.lower())
                 faction = Faction(
                     name=faction_name,
                     description=description,
@@ -593,10 +511,12 @@ class LoreStructure:
             for episode_file in episodes_dir.glob("*.txt"):
                 try:
                     content = episode_file.read_text(encoding='utf-8')
+                    # Леммы считаются лениво (episode_lemmas): поиск по эпизодам их сейчас не использует,
+                    # а лемматизация — самая дорогая часть разбора лора
                     self.episodes_content.append({
                         'file': episode_file.name,
                         'content': content,
-                        'lemmas': get_lemmas(content)
+                        'lemmas': None
                     })
                 except Exception as e:
                     logger.error(f"Ошибка при загрузке эпизода {episode_file.name}: {e}")
@@ -606,117 +526,152 @@ class LoreStructure:
         except Exception as e:
             logger.error(f"Ошибка при загрузке эпизодов: {e}")
     
+    def episode_lemmas(self, idx: int) -> Set[str]:
+        """Леммы эпизода self.episodes_content[idx]; считаются при первом обращении."""
+        episode = self.episodes_content[idx]
+        if episode['lemmas'] is None:
+            episode['lemmas'] = intern_words(get_lemmas(episode['content']))
+        return episode['lemmas']
+    
     def find_character(self, name: str) -> Optional[Character]:
         """Находит персонажа по имени или алиасу"""
-        name_lower = name.lower().strip()
-        key = self.char_aliases_index.get(name_lower)
-        if key:
-            return self.characters.get(key)
-        return None
+        key = self.char_aliases_index.get(name.lower().strip())
+        return self.characters.get(key) if key else None
     
     def find_location(self, name: str) -> Optional[Location]:
         """Находит локацию по имени или алиасу"""
-        name_lower = name.lower().strip()
-        key = self.loc_aliases_index.get(name_lower)
-        if key:
-            return self.locations.get(key)
-        return None
+        key = self.loc_aliases_index.get(name.lower().strip())
+        return self.locations.get(key) if key else None
     
     def find_anomaly(self, name: str) -> Optional[Anomaly]:
         """Находит аномалию по имени"""
-        name_lower = name.lower().strip()
-        return self.anomalies.get(name_lower)
+        return self.anomalies.get(name.lower().strip())
     
     def find_mutant(self, name: str) -> Optional[Mutant]:
         """Находит мутанта по имени"""
-        name_lower = name.lower().strip()
-        return self.mutants.get(name_lower)
+        return self.mutants.get(name.lower().strip())
     
+    def _get_search_index(self) -> "_SearchIndex":
+        """Обратный индекс имён и стемов всех сущностей. Лор не меняется, поэтому строим один раз."""
+        if self._search_index is None:
+            index = _SearchIndex()
+            # Порядок сущностей тот же, что был при обходе словарей: при равных оценках
+            # nlargest оставляет более раннюю, и результаты поиска не меняются
+            categories = (
+                ('characters', self.characters, True),
+                ('locations', self.locations, True),
+                ('anomalies', self.anomalies, False),
+                ('mutants', self.mutants, False),
+            )
+            for kind, registry, with_aliases in categories:
+                name_weight, stem_weight = _SEARCH_WEIGHTS[kind]
+                for key, entity in registry.items():
+                    entity_id = len(index.entities)
+                    index.entities.append((kind, entity))
+                    index.name_weights.append(name_weight)
+                    index.stem_weights.append(stem_weight)
+
+                    # У персонажей и локаций по имени находят и алиасы, в их текст стемов они тоже входят
+                    names = {key, *entity.aliases} if with_aliases else {key}
+                    text = entity.name + ' ' + entity.description
+                    if with_aliases:
+                        text += ' ' + ' '.join(entity.aliases)
+                    for name in names:
+                        index.name_postings.setdefault(name, []).append(entity_id)
+                    for stem in intern_words(get_stemmed_words(text.lower())):
+                        index.stem_postings.setdefault(stem, []).append(entity_id)
+            self._search_index = index
+        return self._search_index
+
     def search_by_keywords(self, query: str, limit: int = 5) -> List[Tuple[str, float]]:
         """
         Ищет в лоре по ключевым словам, возвращает список (контент, оценка релевантности)
         """
         query_stems = get_stemmed_words(query)
-        query_lemmas = get_lemmas(query)
         query_tokens = get_tokens(query)
-        
+        # Пустой запрос (только стоп-слова или знаки) ни с чем не совпадёт — не обходим лор
+        if not query_stems and not query_tokens:
+            return []
+        index = self._get_search_index()
+
+        scores: Dict[int, int] = {}
+
+        # Точное совпадение имени (за сущность считается один раз, сколько бы слов ни совпало)
+        name_matches = set()
+        for token in set(query_tokens):
+            name_matches.update(index.name_postings.get(token, ()))
+        for entity_id in name_matches:
+            scores[entity_id] = index.name_weights[entity_id]
+
+        # Совпадение стемов в описании
+        for stem in query_stems:
+            for entity_id in index.stem_postings.get(stem, ()):
+                scores[entity_id] = scores.get(entity_id, 0) + index.stem_weights[entity_id]
+
+        # Отбираем самые релевантные, не сортируя весь список; текст собираем только для них.
+        # При равной оценке выше та сущность, что раньше в индексе (меньший номер) — как при прежнем обходе словарей
+        top = heapq.nlargest(limit, scores.items(), key=lambda x: (x[1], -x[0]))
         results = []
-        
-        # Поиск по персонажам
-        for char_key, character in self.characters.items():
-            score = 0
-            search_text = (character.name + ' ' + character.description + ' ' + 
-                          ' '.join(character.aliases)).lower()
-            search_stems = get_stemmed_words(search_text)
-            
-            # Точное совпадение имени
-            if any(token in character.aliases or token == char_key for token in query_tokens):
-                score += 50
-            
-            # Совпадение стемов в описании
-            matched_stems = query_stems.intersection(search_stems)
-            score += len(matched_stems) * 10
-            
-            if score > 0:
-                results.append((character.get_full_info(), score))
-        
-        # Поиск по локациям
-        for loc_key, location in self.locations.items():
-            score = 0
-            search_text = (location.name + ' ' + location.description + ' ' + 
-                          ' '.join(location.aliases)).lower()
-            search_stems = get_stemmed_words(search_text)
-            
-            if any(token in location.aliases or token == loc_key for token in query_tokens):
-                score += 40
-            
-            matched_stems = query_stems.intersection(search_stems)
-            score += len(matched_stems) * 8
-            
-            if score > 0:
-                results.append((location.description, score))
-        
-        # Поиск по аномалиям и мутантам аналогично
-        for anomaly_key, anomaly in self.anomalies.items():
-            score = 0
-            search_text = (anomaly.name + ' ' + anomaly.description).lower()
-            search_stems = get_stemmed_words(search_text)
-            
-            if any(token == anomaly_key for token in query_tokens):
-                score += 35
-            
-            matched_stems = query_stems.intersection(search_stems)
-            score += len(matched_stems) * 7
-            
-            if score > 0:
-                results.append((anomaly.description, score))
-        
-        for mutant_key, mutant in self.mutants.items():
-            score = 0
-            search_text = (mutant.name + ' ' + mutant.description).lower()
-            search_stems = get_stemmed_words(search_text)
-            
-            if any(token == mutant_key for token in query_tokens):
-                score += 35
-            
-            matched_stems = query_stems.intersection(search_stems)
-            score += len(matched_stems) * 7
-            
-            if score > 0:
-                results.append((mutant.description, score))
-        
-        # Сортируем по релевантности
-        results.sort(key=lambda x: x[1], reverse=True)
-        
-        return results[:limit]
+        for entity_id, score in top:
+            kind, entity = index.entities[entity_id]
+            content = entity.get_full_info() if kind == 'characters' else entity.description
+            results.append((content, score))
+        return results
+
+
+def _lore_signature() -> tuple:
+    """Отпечаток исходников лора: меняется при изменении любого .txt файла или окружения разбора."""
+    files = []
+    if LORE_DIR.is_dir():
+        for path in LORE_DIR.rglob("*.txt"):
+            stat = path.stat()
+            files.append((str(path.relative_to(LORE_DIR)), stat.st_mtime_ns, stat.st_size))
+    return (_LORE_CACHE_VERSION, type(STEMMER).__name__, MORPH is not None, tuple(sorted(files)))
+
+
+def _load_cached_structure(signature: tuple) -> Optional[LoreStructure]:
+    """Читает разобранный лор из кэша, если он собран из тех же файлов."""
+    try:
+        cached_signature, structure = pickle.loads(LORE_CACHE_PATH.read_bytes())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать кэш лора {LORE_CACHE_PATH}: {e}")
+        return None
+    if cached_signature != signature:
+        logger.info("Файлы лора изменились — кэш будет пересобран.")
+        return None
+    return structure
+
+
+def _save_cached_structure(signature: tuple, structure: LoreStructure):
+    """Сохраняет разобранный лор в кэш (через временный файл, чтобы не оставить битый кэш)."""
+    try:
+        tmp_path = LORE_CACHE_PATH.with_suffix(".tmp")
+        tmp_path.write_bytes(pickle.dumps((signature, structure), protocol=pickle.HIGHEST_PROTOCOL))
+        tmp_path.replace(LORE_CACHE_PATH)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить кэш лора {LORE_CACHE_PATH}: {e}")
 
 
 # Глобальный экземпляр
 LORE = None
+# Лор может запрашиваться одновременно из фоновой предзагрузки и из потоков поиска —
+# разбор и запись кэша должны выполниться один раз
+_LORE_LOCK = threading.Lock()
 
 def get_lore_structure() -> LoreStructure:
     """Возвращает или создаёт глобальный экземпляр структурированного лора"""
     global LORE
     if LORE is None:
-        LORE = LoreStructure()
+        with _LORE_LOCK:
+            if LORE is None:
+                signature = _lore_signature()
+                structure = _load_cached_structure(signature)
+                if structure is not None:
+                    logger.info(f"Структурированный лор загружен из кэша {LORE_CACHE_PATH}")
+                else:
+                    structure = LoreStructure()
+                    _save_cached_structure(signature, structure)
+                LORE = structure
     return LORE